@@ -99,6 +99,7 @@ setuptools.setup(
         "dev": [
             "pre-commit",
             "pytest",
+            "pytest-xdist",
             "flake8",
             "black",
             "mypy",
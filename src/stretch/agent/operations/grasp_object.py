@@ -15,13 +15,15 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
+import math
 import time
 import timeit
-from typing import Optional, Tuple
+from typing import Dict, Optional, Tuple
 
 import cv2
 import numpy as np
 import torch
+from numba import njit
 from scipy.spatial.transform import Rotation as R
 
 import stretch.motion.constants as constants
@@ -35,6 +37,58 @@ from stretch.utils.gripper import GripperArucoDetector
 from stretch.utils.point_cloud import show_point_cloud
 
 
+@njit(cache=True)
+def _servo_control_step(
+    dx: float,
+    dy: float,
+    base_x: float,
+    wrist_pitch: float,
+    arm: float,
+    lift: float,
+    mask_height: float,
+    mask_width: float,
+    align_x_threshold: float,
+    align_y_threshold: float,
+    base_x_step: float,
+    wrist_pitch_step: float,
+    lift_arm_ratio: float,
+) -> Tuple[float, float, float, float, bool]:
+    """One step of visual servoing control. Decides if we are aligned to the object, and where to move the base, wrist, arm and lift next.
+
+    Args:
+        dx (float): Horizontal offset of the mask center from the tracked image point, in pixels
+        dy (float): Vertical offset of the mask center from the tracked image point, in pixels
+
+    Returns:
+        Tuple[float, float, float, float, bool]: base_x, wrist_pitch, arm, lift and whether we are aligned
+    """
+    aligned = abs(dx) < align_x_threshold and abs(dy) < align_y_threshold
+
+    # If we are aligned, step the whole thing closer by some amount
+    # This is based on the pitch - basically
+    if aligned:
+        arm += math.cos(wrist_pitch) * lift_arm_ratio
+        lift += math.sin(wrist_pitch) * lift_arm_ratio
+
+    # Add these to do some really hacky proportionate control
+    px = max(0.25, abs(2 * dx / mask_width))
+    py = max(0.25, abs(2 * dy / mask_height))
+
+    # Move the base and modify the wrist pitch
+    if dx > align_x_threshold:
+        # Move in x - this means translate the base
+        base_x += -base_x_step * px
+    elif dx < -1 * align_x_threshold:
+        base_x += base_x_step * px
+    if dy > align_y_threshold:
+        # Move in y - this means translate the base
+        wrist_pitch += -wrist_pitch_step * py
+    elif dy < -1 * align_y_threshold:
+        wrist_pitch += wrist_pitch_step * py
+
+    return base_x, wrist_pitch, arm, lift, aligned
+
+
 class GraspObjectOperation(ManagedOperation):
     """Move the robot to grasp, using the end effector camera."""
 
@@ -59,6 +113,7 @@ class GraspObjectOperation(ManagedOperation):
     show_object_to_grasp: bool = False
     show_servo_gui: bool = False
     show_point_cloud: bool = False
+    _gui_image: Optional[np.ndarray] = None
 
     # This will delete the object from instance memory/voxel map after grasping
     delete_object_after_grasp: bool = False
@@ -120,10 +175,35 @@ class GraspObjectOperation(ManagedOperation):
     max_failed_attempts: int = 10
     max_random_motions: int = 10
 
+    # Scratch buffers for intermediate masks, keyed by name
+    _scratch_masks: Optional[Dict[str, np.ndarray]] = None
+
+    # Kernel used to dilate the target mask
+    _dilation_kernel: np.ndarray = np.ones((3, 3), np.uint8)
+
     # Timing issues
+    # After each motion, wait for this many new servo frames, or at most expected_network_delay
     expected_network_delay = 0.4
+    servo_frames_to_wait: int = 2
     open_loop: bool = False
 
+    # Cached lookup table from semantic class id to "matches the target class"
+    _class_lut: Optional[np.ndarray] = None
+    _class_lut_key: Optional[Tuple] = None
+    _class_lut_ids: Optional[np.ndarray] = None
+
+    # Reuse the last end-effector segmentation if the camera has not moved and the image has not
+    # changed. Images are compared as small thumbnails by mean absolute difference in pixel values.
+    reuse_semantic_predictions: bool = True
+    semantic_reuse_image_threshold: float = 2.0
+    semantic_reuse_joint_tolerance: float = 1e-3
+    _semantic_thumbnail_size: Tuple[int, int] = (32, 32)
+    _last_semantic_thumbnail: Optional[np.ndarray] = None
+    _last_semantic_joint_state: Optional[np.ndarray] = None
+    _last_semantic: Optional[np.ndarray] = None
+    _last_instance: Optional[np.ndarray] = None
+    _last_servo_command: Optional[np.ndarray] = None
+
     # Observation memory
     observations = MaskTemporalFilter(
         observation_history_window_size_secs=5.0, observation_history_window_size_n=3
@@ -226,21 +306,54 @@ class GraspObjectOperation(ManagedOperation):
             float: Center depth of the object
         """
         # Compute depth as median of object pixels near center_y, center_x
-        # Make a mask of radius 10 around the center
-        mask = np.zeros_like(target_mask)
-        mask[
-            max(center_y - local_region_size, 0) : min(center_y + local_region_size, mask.shape[0]),
-            max(center_x - local_region_size, 0) : min(center_x + local_region_size, mask.shape[1]),
-        ] = 1
+        # Only look at the window of radius local_region_size around the center
+        rows = slice(
+            max(center_y - local_region_size, 0),
+            min(center_y + local_region_size, target_mask.shape[0]),
+        )
+        cols = slice(
+            max(center_x - local_region_size, 0),
+            min(center_x + local_region_size, target_mask.shape[1]),
+        )
+        local_depth = servo.ee_depth[rows, cols]
 
         # Ignore depth of 0 (bad value)
-        depth_mask = np.bitwise_and(servo.ee_depth > 1e-8, mask)
+        depth_mask = np.bitwise_and(local_depth > 1e-8, target_mask[rows, cols])
 
-        depth = servo.ee_depth[target_mask & depth_mask]
+        depth = local_depth[depth_mask]
         median_depth = np.median(depth)
         # print(f"Center depth: {median_depth}")
         return median_depth
 
+    def _get_class_lut(self, target_class: str, max_id: int) -> np.ndarray:
+        """Get a boolean lookup table indexed by semantic class id, which is True for every class whose name contains the target class. The table is cached and only rebuilt when the target class, semantic sensor or vocabulary changes, or when it does not cover max_id.
+
+        Args:
+            target_class (str): Name of the class we are trying to grasp
+            max_id (int): Largest class id that the table must cover
+
+        Returns:
+            np.ndarray: Boolean lookup table over class ids
+        """
+        semantic_sensor = self.agent.semantic_sensor
+        key = (
+            target_class,
+            id(semantic_sensor),
+            getattr(semantic_sensor, "current_vocabulary_id", None),
+        )
+        if self._class_lut is None or self._class_lut_key != key or len(self._class_lut) <= max_id:
+            size = max_id + 1
+            if self._class_lut is not None and self._class_lut_key == key:
+                size = max(size, len(self._class_lut))
+            class_lut = np.zeros(size, dtype=bool)
+            for iid in range(size):
+                name = semantic_sensor.get_class_name_for_id(iid)
+                class_lut[iid] = name is not None and target_class in name
+            self._class_lut = class_lut
+            self._class_lut_ids = np.flatnonzero(class_lut)
+            self._class_lut_key = key
+        return self._class_lut
+
     def get_class_mask(self, servo: Observations) -> np.ndarray:
         """Get the mask for the class of the object we are trying to grasp. Multiple options might be acceptable.
 
@@ -250,8 +363,6 @@ class GraspObjectOperation(ManagedOperation):
         Returns:
             np.ndarray: Mask for the class of the object we are trying to grasp
         """
-        mask = np.zeros_like(servo.semantic).astype(bool)  # type: ignore
-
         if self.verbose:
             print("[GRASP OBJECT] match method =", self.match_method)
         if self.match_method == "class":
@@ -266,11 +377,19 @@ class GraspObjectOperation(ManagedOperation):
             if self.verbose:
                 print("[GRASP OBJECT] Detecting objects of class", target_class)
 
-            # Now find the mask with that class
-            for iid in np.unique(servo.semantic):
-                name = self.agent.semantic_sensor.get_class_name_for_id(iid)
-                if name is not None and target_class in name:
-                    mask = np.bitwise_or(mask, servo.semantic == iid)
+            # Now find the mask with that class, using a lookup table over class ids
+            self._get_class_lut(target_class, int(servo.semantic.max()))
+            if len(self._class_lut_ids) == 0:
+                # No class matches, so there is nothing to look up
+                mask = np.zeros(servo.semantic.shape, dtype=bool)
+            elif len(self._class_lut_ids) == 1:
+                # A single comparison is cheaper than a gather
+                mask = servo.semantic == self._class_lut_ids[0]
+            else:
+                mask = self._class_lut[servo.semantic]
+                if servo.semantic.min() < 0:
+                    # Negative ids (e.g. -1 for background) would wrap around the table
+                    mask &= servo.semantic >= 0
         elif self.match_method == "feature":
             if self.target_object is None:
                 raise ValueError(
@@ -284,7 +403,12 @@ class GraspObjectOperation(ManagedOperation):
             best_score = float("-inf")
             best_iid = None
             all_matches = []
-            for iid in np.unique(servo.instance):
+
+            # Count points per instance in one pass; the background (-1) lands in bin 0. Instances
+            # too small to approach are skipped before running the image encoder on them.
+            instance_counts = np.bincount(servo.instance.ravel().astype(np.int64) + 1)
+            candidate_iids = np.nonzero(instance_counts >= self.min_points_to_approach)[0] - 1
+            for iid in candidate_iids:
 
                 # Ignore the background
                 if iid < 0:
@@ -309,6 +433,7 @@ class GraspObjectOperation(ManagedOperation):
                     print(f" - Matched {iid} with score {score}.")
             if len(all_matches) == 0:
                 print("[MASK SELECTION] No matches found.")
+                mask = np.zeros(servo.semantic.shape, dtype=bool)
             elif len(all_matches) == 1:
                 print("[MASK SELECTION] One match found. We are done.")
                 mask = servo.instance == best_iid
@@ -356,6 +481,91 @@ class GraspObjectOperation(ManagedOperation):
         self._success = False
         self.tracked_object_features = None
         self.observations.clear_history()
+        self._invalidate_semantic_cache()
+        self._last_servo_command = None
+
+    def _invalidate_semantic_cache(self) -> None:
+        """Forget the cached end-effector segmentation, so that the next frame is segmented again."""
+        self._last_semantic_thumbnail = None
+        self._last_semantic_joint_state = None
+        self._last_semantic = None
+        self._last_instance = None
+
+    def _predict_ee_semantics(
+        self,
+        servo: Observations,
+        joint_state: np.ndarray,
+        prev_target_mask: Optional[np.ndarray] = None,
+    ) -> Observations:
+        """Run semantic segmentation on the end-effector image. The cached semantic and instance masks are reused instead of running the network again if nothing was commanded since the last prediction and the previous target mask still sees valid depth, or if the joints have not moved and a thumbnail of the image is close to the last one we segmented.
+
+        Args:
+            servo (Observations): Servo observation
+            joint_state (np.ndarray): Joint positions the observation was taken at
+            prev_target_mask (Optional[np.ndarray], optional): Target mask from the previous step. Defaults to None.
+
+        Returns:
+            Observations: Servo observation with semantic and instance masks filled in
+        """
+        if not self.reuse_semantic_predictions:
+            return self.agent.semantic_sensor.predict(servo, ee=True)
+
+        # The cache is dropped whenever a new motion is commanded, so if it is still here the
+        # robot has not been told to move; reuse it as long as the last target is still visible
+        if (
+            self._last_semantic is not None
+            and prev_target_mask is not None
+            and self._last_semantic.shape == servo.ee_rgb.shape[:2]
+            and prev_target_mask.shape == servo.ee_depth.shape
+            and np.count_nonzero(prev_target_mask & (servo.ee_depth > 1e-8))
+            > self.min_points_to_approach
+        ):
+            servo.semantic = self._last_semantic
+            servo.instance = self._last_instance
+            return servo
+
+        thumbnail = cv2.resize(
+            servo.ee_rgb, self._semantic_thumbnail_size, interpolation=cv2.INTER_AREA
+        ).astype(np.float32)
+        if (
+            self._last_semantic_thumbnail is not None
+            and self._last_semantic.shape == servo.ee_rgb.shape[:2]
+            and np.allclose(
+                joint_state,
+                self._last_semantic_joint_state,
+                atol=self.semantic_reuse_joint_tolerance,
+            )
+            and np.abs(thumbnail - self._last_semantic_thumbnail).mean()
+            < self.semantic_reuse_image_threshold
+        ):
+            servo.semantic = self._last_semantic
+            servo.instance = self._last_instance
+            return servo
+
+        servo = self.agent.semantic_sensor.predict(servo, ee=True)
+        self._last_semantic_thumbnail = thumbnail
+        self._last_semantic_joint_state = np.array(joint_state, copy=True)
+        self._last_semantic = servo.semantic
+        self._last_instance = servo.instance
+        return servo
+
+    def _get_scratch_mask(self, name: str, shape: Tuple[int, ...]) -> np.ndarray:
+        """Get a reusable boolean scratch buffer, reallocating it if the image shape changed.
+
+        Args:
+            name (str): Name of the buffer
+            shape (Tuple[int, ...]): Shape of the buffer
+
+        Returns:
+            np.ndarray: Boolean scratch buffer with undefined contents
+        """
+        if self._scratch_masks is None:
+            self._scratch_masks = {}
+        buffer = self._scratch_masks.get(name)
+        if buffer is None or buffer.shape != shape:
+            buffer = np.empty(shape, dtype=bool)
+            self._scratch_masks[name] = buffer
+        return buffer
 
     def get_target_mask(
         self,
@@ -378,47 +588,37 @@ class GraspObjectOperation(ManagedOperation):
         if servo.ee_xyz is None:
             servo.compute_ee_xyz()
 
-        target_mask = None
-        target_mask_pts = float("-inf")
-        maximum_overlap_mask = None
-        maximum_overlap_pts = float("-inf")
         center_x, center_y = center
 
-        # Loop over all detected instances -- finding the one that matches our target object
-        for iid in np.unique(instance_mask):
-            current_instance_mask = instance_mask == iid
-
-            # If we are centered on the mask and it's the right class, just go for it
-            if class_mask[center_y, center_x] > 0 and current_instance_mask[center_y, center_x] > 0:
-                # This is the correct one - it's centered and the right class. Just go there.
-                print("!!! CENTERED ON THE RIGHT OBJECT !!!")
-                return current_instance_mask
-
-            # Option 2 - try to find the map that most overlapped with what we were just trying to grasp
-            # This is in case we are losing track of particular objects and getting classes mixed up
-            if prev_mask is not None and self.use_prev_mask:
-                # Find the mask with the most points
-                mask = np.bitwise_and(current_instance_mask, prev_mask)
-                mask = np.bitwise_and(mask, class_mask)
-                num_pts = sum(mask.flatten())
-
-                if num_pts > maximum_overlap_pts:
-                    maximum_overlap_pts = num_pts
-                    maximum_overlap_mask = mask
-
-            # Simply find the mask with the most points
-            mask = np.bitwise_and(current_instance_mask, class_mask)
-            num_pts = sum(mask.flatten())
-            if num_pts > target_mask_pts:
-                target_mask = mask
-                target_mask_pts = num_pts
-
-        if maximum_overlap_pts > self.min_points_to_approach:
-            return maximum_overlap_mask
-        if target_mask is not None:
-            return target_mask
-        else:
-            return prev_mask
+        # If we are centered on the mask and it's the right class, just go for it
+        if class_mask[center_y, center_x] > 0:
+            # This is the correct one - it's centered and the right class. Just go there.
+            print("!!! CENTERED ON THE RIGHT OBJECT !!!")
+            return instance_mask == instance_mask[center_y, center_x]
+
+        # Tally points per instance in a single pass instead of looping over every instance.
+        # Only the selected pixels are shifted, so that the background (-1) gets a bin of its own.
+        min_iid = int(instance_mask.min())
+        num_bins = int(instance_mask.max()) - min_iid + 1
+
+        # Option 2 - try to find the map that most overlapped with what we were just trying to grasp
+        # This is in case we are losing track of particular objects and getting classes mixed up
+        # Intermediate masks are written into scratch buffers; only the returned mask is allocated
+        instance_scratch = self._get_scratch_mask("instance", instance_mask.shape)
+        if prev_mask is not None and self.use_prev_mask:
+            overlap_mask = self._get_scratch_mask("overlap", instance_mask.shape)
+            np.bitwise_and(class_mask, prev_mask, out=overlap_mask)
+            overlap_counts = np.bincount(instance_mask[overlap_mask] - min_iid, minlength=num_bins)
+            overlap_bin = overlap_counts.argmax()
+            if overlap_counts[overlap_bin] > self.min_points_to_approach:
+                np.equal(instance_mask, overlap_bin + min_iid, out=instance_scratch)
+                return np.bitwise_and(instance_scratch, overlap_mask)
+
+        # Simply find the mask with the most points
+        target_counts = np.bincount(instance_mask[class_mask] - min_iid, minlength=num_bins)
+        target_bin = target_counts.argmax()
+        np.equal(instance_mask, target_bin + min_iid, out=instance_scratch)
+        return np.bitwise_and(instance_scratch, class_mask)
 
     def sayable_target_object(self) -> str:
         """Get the target object in a sayable format.
@@ -455,8 +655,8 @@ class GraspObjectOperation(ManagedOperation):
                 print("Distance to move:", distance)
                 if distance > 0:
                     # Use wrist pitch to compute arm and lift offsets
-                    arm_component = np.cos(wrist_pitch) * distance
-                    lift_component = np.sin(wrist_pitch) * distance
+                    arm_component = math.cos(wrist_pitch) * distance
+                    lift_component = math.sin(wrist_pitch) * distance
                 else:
                     arm_component = 0
                     lift_component = 0
@@ -491,6 +691,37 @@ class GraspObjectOperation(ManagedOperation):
         self.robot.arm_to(lifted_joint_state, head=constants.look_at_ee, blocking=True)
         return True
 
+    def _get_gui_buffer(self, shape: Tuple[int, ...]) -> np.ndarray:
+        """Get the image buffer for the servo GUI, reallocating it if the image shape changed.
+
+        Args:
+            shape: Shape of the side by side RGB and depth visualization
+
+        Returns:
+            np.ndarray: BGR image buffer
+        """
+        if self._gui_image is None or self._gui_image.shape != shape:
+            self._gui_image = np.empty(shape, dtype=np.uint8)
+        return self._gui_image
+
+    def _wait_for_new_servo_observation(self, timeout: float) -> None:
+        """Wait until the robot has sent servo_frames_to_wait new servo observations, so that the next image was taken after the last motion finished. Gives up after the timeout.
+
+        Args:
+            timeout (float): Maximum time to wait, in seconds
+        """
+        t0 = timeit.default_timer()
+        last_servo = self.robot.get_servo_observation()
+        new_frames = 0
+        while new_frames < self.servo_frames_to_wait:
+            if timeit.default_timer() - t0 > timeout:
+                break
+            time.sleep(0.01)
+            servo = self.robot.get_servo_observation()
+            if servo is not last_servo:
+                last_servo = servo
+                new_frames += 1
+
     def visual_servo_to_object(
         self, instance: Instance, max_duration: float = 120.0, max_not_moving_count: int = 50
     ) -> bool:
@@ -516,6 +747,7 @@ class GraspObjectOperation(ManagedOperation):
         # Track the fingertips using aruco markers
         if self.gripper_aruco_detector is None:
             self.gripper_aruco_detector = GripperArucoDetector()
+        self.gripper_aruco_detector.reset_tracking()
 
         # Track the last object location and the number of times we've failed to grasp
         current_xyz = None
@@ -544,7 +776,11 @@ class GraspObjectOperation(ManagedOperation):
 
             # Get servo observation
             servo = self.robot.get_servo_observation()
-            joint_state = self.robot.get_joint_positions()
+            # Servo messages carry the joint state they were taken at; only fall back to the
+            # separately-updated robot state if it is missing
+            joint_state = servo.joint
+            if joint_state is None:
+                joint_state = self.robot.get_joint_positions()
             world_xyz = servo.get_ee_xyz_in_world_frame()
 
             if not self.open_loop:
@@ -558,7 +794,7 @@ class GraspObjectOperation(ManagedOperation):
             if self.track_image_center:
                 center_x, center_y = servo.ee_rgb.shape[1] // 2, servo.ee_rgb.shape[0] // 2
             else:
-                center = self.gripper_aruco_detector.detect_center(servo.ee_rgb)
+                center = self.gripper_aruco_detector.track_center(servo.ee_rgb)
                 if center is not None:
                     center_y, center_x = np.round(center).astype(int)
                     center_y += self.detected_center_offset_y
@@ -569,16 +805,16 @@ class GraspObjectOperation(ManagedOperation):
             center_x -= 10  # move closer to top
 
             # Run semantic segmentation on it
-            servo = self.agent.semantic_sensor.predict(servo, ee=True)
+            servo = self._predict_ee_semantics(servo, joint_state, prev_target_mask)
             latest_mask = self.get_target_mask(
                 servo, prev_mask=prev_target_mask, center=(center_x, center_y)
             )
 
-            # dilate mask
-            kernel = np.ones((3, 3), np.uint8)
-            mask_np = latest_mask.astype(np.uint8)
-            dilated_mask = cv2.dilate(mask_np, kernel, iterations=1)
-            latest_mask = dilated_mask.astype(bool)
+            # dilate mask - bool and uint8 share a layout, so view the mask instead of copying it
+            dilated_mask = cv2.dilate(
+                latest_mask.view(np.uint8), self._dilation_kernel, iterations=1
+            )
+            latest_mask = dilated_mask.view(bool)
 
             # push to history
             self.observations.push_mask_to_observation_history(
@@ -634,34 +870,39 @@ class GraspObjectOperation(ManagedOperation):
 
             # Optionally display which object we are servoing to
             if self.show_servo_gui and not self.headless_machine:
-                servo_ee_rgb = cv2.cvtColor(servo.ee_rgb, cv2.COLOR_RGB2BGR)
-                mask = target_mask.astype(np.uint8) * 255
-                mask = cv2.cvtColor(mask, cv2.COLOR_GRAY2BGR)
-                mask[:, :, 0] = 0
-
-                # Create an RGB image with the mask overlaid
-                servo_ee_rgb = cv2.addWeighted(servo_ee_rgb, 0.5, mask, 0.5, 0, servo_ee_rgb)
+                # Both images are drawn straight into one side by side buffer
+                rgb_width = servo.ee_rgb.shape[1]
+                viz_image = self._get_gui_buffer(
+                    (servo.ee_rgb.shape[0], rgb_width + servo.ee_depth.shape[1], 3)
+                )
+                servo_ee_rgb = viz_image[:, :rgb_width]
+                viz_ee_depth = viz_image[:, rgb_width:]
+                cv2.cvtColor(servo.ee_rgb, cv2.COLOR_RGB2BGR, dst=servo_ee_rgb)
+
+                # Overlay the mask in place: halve blue and blend green and red halfway to 255
+                masked_pixels = servo_ee_rgb[target_mask]
+                masked_pixels >>= 1
+                masked_pixels[:, 1:] += 127
+                servo_ee_rgb[target_mask] = masked_pixels
                 # Draw the center of the image
-                servo_ee_rgb = cv2.circle(servo_ee_rgb, (center_x, center_y), 5, (255, 0, 0), -1)
+                cv2.circle(servo_ee_rgb, (center_x, center_y), 5, (255, 0, 0), -1)
                 # Draw the center of the mask
-                servo_ee_rgb = cv2.circle(
+                cv2.circle(
                     servo_ee_rgb, (int(mask_center[1]), int(mask_center[0])), 5, (0, 255, 0), -1
                 )
 
                 # Create a depth image with the center of the mask
-                # First convert to 32-bit float
-                viz_ee_depth = cv2.normalize(servo.ee_depth, None, 0, 255, cv2.NORM_MINMAX)
-                viz_ee_depth = viz_ee_depth.astype(np.uint8)
-                viz_ee_depth = cv2.applyColorMap(viz_ee_depth, cv2.COLORMAP_JET)
-                viz_ee_depth = cv2.circle(
+                # Normalize straight to 8 bits before applying the color map
+                depth_u8 = cv2.normalize(
+                    servo.ee_depth, None, 0, 255, cv2.NORM_MINMAX, dtype=cv2.CV_8U
+                )
+                cv2.applyColorMap(depth_u8, cv2.COLORMAP_JET, dst=viz_ee_depth)
+                cv2.circle(
                     viz_ee_depth, (int(mask_center[1]), int(mask_center[0])), 5, (0, 255, 0), -1
                 )
 
-                # Concatenate the two images side by side
-                viz_image = np.concatenate([servo_ee_rgb, viz_ee_depth], axis=1)
                 cv2.namedWindow("Visual Servoing", cv2.WINDOW_NORMAL)
                 cv2.imshow("Visual Servoing", viz_image)
-                cv2.waitKey(1)
                 res = cv2.waitKey(1) & 0xFF  # 0xFF is a mask to get the last 8 bits
                 if res == ord("q"):
                     break
@@ -676,7 +917,17 @@ class GraspObjectOperation(ManagedOperation):
             # Otherwise we will just try to grasp if we are close enough - assume we lost track!
             if target_mask is not None:
                 object_depth = servo.ee_depth[target_mask]
-                median_object_depth = np.median(servo.ee_depth[target_mask]) / 1000
+                if object_depth.size > 0:
+                    # Quickselect the median instead of sorting all of the object's depth values
+                    k = object_depth.size // 2
+                    if object_depth.size % 2 == 1:
+                        median_object_depth = np.partition(object_depth, k)[k] / 1000
+                    else:
+                        # Average the two middle values, as np.median does
+                        middle = np.partition(object_depth, (k - 1, k))[k - 1 : k + 1]
+                        median_object_depth = middle.mean() / 1000
+                else:
+                    median_object_depth = float("nan")
             else:
                 # print("detected classes:", np.unique(servo.ee_semantic))
                 if center_depth < self.median_distance_when_grasping:
@@ -692,15 +943,27 @@ class GraspObjectOperation(ManagedOperation):
             center_in_mask = target_mask[int(center_y), int(center_x)] > 0
             # TODO: add deadband bubble around this?
 
-            # Since we were able to detect it, copy over the target mask
-            prev_target_mask = target_mask
-
-            # Are we aligned to the object
-            aligned = np.abs(dx) < self.align_x_threshold and np.abs(dy) < self.align_y_threshold
+            # Are we aligned to the object, and where should the joints go next?
+            # Lift is fixed to only go down.
+            next_base_x, next_wrist_pitch, next_arm, next_lift, aligned = _servo_control_step(
+                float(dx),
+                float(dy),
+                float(base_x),
+                float(wrist_pitch),
+                float(arm),
+                float(min(lift, prev_lift)),
+                float(target_mask.shape[0]),
+                float(target_mask.shape[1]),
+                float(self.align_x_threshold),
+                float(self.align_y_threshold),
+                float(self.base_x_step),
+                float(self.wrist_pitch_step),
+                float(self.lift_arm_ratio),
+            )
 
             print()
             print("----- STEP VISUAL SERVOING -----")
-            print("Observed this many target mask points:", np.sum(target_mask.flatten()))
+            print("Observed this many target mask points:", np.count_nonzero(target_mask))
             if self.verbose:
                 print("failed =", failed_counter, "/", self.max_failed_attempts)
                 print("cur x =", base_x)
@@ -716,9 +979,6 @@ class GraspObjectOperation(ManagedOperation):
                 print("Current XYZ:", current_xyz)
             print("Aligned?", aligned)
 
-            # Fix lift to only go down
-            lift = min(lift, prev_lift)
-
             # If we are aligned, try to grasp
             if aligned:
                 # First, check to see if we are close enough to grasp
@@ -736,36 +996,15 @@ class GraspObjectOperation(ManagedOperation):
                         success = self._grasp(distance=center_depth)
                     break
 
-                # If we are aligned, step the whole thing closer by some amount
-                # This is based on the pitch - basically
+                # If we are aligned, the whole thing is stepped closer by some amount
                 aligned_once = True
-                arm_component = np.cos(wrist_pitch) * self.lift_arm_ratio
-                lift_component = np.sin(wrist_pitch) * self.lift_arm_ratio
-
-                arm += arm_component
-                lift += lift_component
-
-            if True:
-                # Add these to do some really hacky proportionate control
-                px = max(0.25, np.abs(2 * dx / target_mask.shape[1]))
-                py = max(0.25, np.abs(2 * dy / target_mask.shape[0]))
-
-                # Move the base and modify the wrist pitch
-                # TODO: remove debug code
-                # print(f"dx={dx}, dy={dy}, px={px}, py={py}")
-                if dx > self.align_x_threshold:
-                    # Move in x - this means translate the base
-                    base_x += -self.base_x_step * px
-                elif dx < -1 * self.align_x_threshold:
-                    base_x += self.base_x_step * px
-                if dy > self.align_y_threshold:
-                    # Move in y - this means translate the base
-                    wrist_pitch += -self.wrist_pitch_step * py
-                elif dy < -1 * self.align_y_threshold:
-                    wrist_pitch += self.wrist_pitch_step * py
-
-            # Force to reacquire the target mask if we moved the camera too much
-            prev_target_mask = None
+
+            # Move the base and modify the wrist pitch
+            base_x, wrist_pitch, arm, lift = next_base_x, next_wrist_pitch, next_arm, next_lift
+
+            # Keep the target mask only if we are aligned, since the base and wrist will not move;
+            # otherwise force to reacquire the target mask, since we moved the camera too much
+            prev_target_mask = target_mask if aligned else None
 
             # safety checks
             q = [
@@ -796,13 +1035,23 @@ class GraspObjectOperation(ManagedOperation):
             print("  arm =", arm)
             print("pitch =", wrist_pitch)
 
+            # Any commanded motion changes what the camera sees
+            servo_command = np.array([base_x, lift, arm, wrist_pitch])
+            if (
+                self._last_servo_command is None
+                or np.abs(servo_command - self._last_servo_command).max()
+                > self.semantic_reuse_joint_tolerance
+            ):
+                self._invalidate_semantic_cache()
+            self._last_servo_command = servo_command
+
             self.robot.arm_to(
                 [base_x, lift, arm, 0, wrist_pitch, 0],
                 head=constants.look_at_ee,
                 blocking=True,
             )
             prev_lift = lift
-            time.sleep(self.expected_network_delay)
+            self._wait_for_new_servo_observation(timeout=self.expected_network_delay)
 
             # check not moving
             if np.linalg.norm(q - q_last) < 0.05:  # TODO: tune
@@ -847,7 +1096,6 @@ class GraspObjectOperation(ManagedOperation):
         # Get the end effector pose
         obs = self.robot.get_observation()
         joint_state = self.robot.get_joint_positions()
-        model = self.robot.get_robot_model()
 
         if joint_state[HelloStretchIdx.GRIPPER] < 0.0:
             self.robot.open_gripper(blocking=True)
@@ -863,9 +1111,9 @@ class GraspObjectOperation(ManagedOperation):
         # Compute the angles necessary
         if self.use_pitch_from_vertical:
             head_pos = obs.camera_pose[:3, 3]
-            dy = np.abs(head_pos[1] - relative_object_xyz[1])
-            dz = np.abs(head_pos[2] - relative_object_xyz[2])
-            pitch_from_vertical = np.arctan2(dy, dz)
+            dy = abs(head_pos[1] - relative_object_xyz[1])
+            dz = abs(head_pos[2] - relative_object_xyz[2])
+            pitch_from_vertical = math.atan2(dy, dz)
         else:
             pitch_from_vertical = 0.0
 
@@ -909,8 +1157,7 @@ class GraspObjectOperation(ManagedOperation):
 
         joint_state = self.robot.get_joint_positions()
 
-        model = self.robot.get_robot_model()
-        ee_pos, ee_rot = model.manip_fk(joint_state)
+        ee_pos, ee_rot = self.robot_model.manip_fk(joint_state)
 
         vector_to_object = relative_object_xyz - ee_pos
         vector_to_object = vector_to_object / np.linalg.norm(vector_to_object)
@@ -981,13 +1228,12 @@ class GraspObjectOperation(ManagedOperation):
             bool: True if successful, False otherwise
         """
 
-        model = self.robot.get_robot_model()
         xyt = self.robot.get_base_pose()
         relative_object_xyz = point_global_to_base(object_xyz, xyt)
         joint_state = self.robot.get_joint_positions()
 
         # We assume the current end-effector orientation is the correct one, going into this
-        ee_pos, ee_rot = model.manip_fk(joint_state)
+        ee_pos, ee_rot = self.robot_model.manip_fk(joint_state)
 
         # If we failed, or if we are not servoing, then just move to the object
         target_joint_positions, _, _, success, _ = self.robot_model.manip_ik_for_grasp_frame(
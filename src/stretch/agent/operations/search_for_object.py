@@ -7,7 +7,11 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
+import functools
 import time
+import weakref
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 
 import numpy as np
@@ -17,6 +21,52 @@ from PIL import Image
 import stretch.core.status as status
 from stretch.agent.base import ManagedOperation
 from stretch.mapping.instance import Instance
+from stretch.utils.logger import Logger
+
+logger = Logger(__name__)
+
+# Text features for object classes, shared by all search operations in this process. Held per
+# encoder object, not per id(), so that switching encoders never returns a stale feature; an
+# encoder's features are dropped when it is garbage collected.
+_text_feature_cache: "weakref.WeakKeyDictionary[object, OrderedDict[str, torch.Tensor]]" = (
+    weakref.WeakKeyDictionary()
+)
+_text_feature_cache_size: int = 32
+
+
+# Writes debug images off the search loop. One worker, so saves to the same file stay in order.
+_image_writer = ThreadPoolExecutor(max_workers=1)
+
+
+def _save_image_async(image: np.ndarray, filename: str) -> None:
+    """Encode and write an image in the background. The caller must not modify the image afterwards."""
+    _image_writer.submit(lambda: Image.fromarray(image).save(filename))
+
+
+def _score_features(embs: torch.Tensor, query: torch.Tensor) -> torch.Tensor:
+    """Cosine similarity of each row of embs [N, D] with query [D]."""
+    return torch.nn.functional.normalize(embs, dim=-1) @ torch.nn.functional.normalize(
+        query, dim=-1
+    )
+
+
+@functools.lru_cache(maxsize=1)
+def _get_compiled_score_features():
+    """Compile _score_features on first use so the normalize and matmul are fused. Falls back to eager mode if torch.compile is unavailable."""
+    if not hasattr(torch, "compile"):
+        return _score_features
+    return torch.compile(_score_features, dynamic=True)
+
+
+@functools.lru_cache(maxsize=1)
+def _get_plt():
+    """Import pyplot with the TkAgg backend. The backend is only configured on first use."""
+    import matplotlib
+
+    matplotlib.use("TkAgg")
+    import matplotlib.pyplot as plt
+
+    return plt
 
 
 class ManagedSearchOperation(ManagedOperation):
@@ -24,6 +74,7 @@ class ManagedSearchOperation(ManagedOperation):
     # For debugging
     show_map_so_far: bool = False
     show_instances_detected: bool = False
+    max_instances_to_show: int = 5
 
     # Important parameters
     _object_class: Optional[str] = None
@@ -32,6 +83,19 @@ class ManagedSearchOperation(ManagedOperation):
     # How to choose the features from multiple views
     aggregation_method: str = "mean"
 
+    # If set, feature matching only scores instances whose class name already matches the target
+    # class. Much cheaper in cluttered maps, but misses objects the detector vocabulary labels
+    # differently, so it is off by default.
+    prefilter_by_name: bool = False
+
+    # Use torch.compile for feature scoring. Compiling takes a few seconds on first use, so this
+    # only pays off for long-running processes that search large maps many times.
+    compile_feature_scoring: bool = False
+
+    # Score features in bfloat16 on GPU. Similarities can move by ~1e-2, which can flip instances
+    # that sit right at the match threshold, so this is opt-in. CPU scoring always stays in float32.
+    half_precision_scoring: bool = False
+
     # Whether to talk or not
     talk: bool = True
     talk_t: float = 3.0
@@ -49,12 +113,49 @@ class ManagedSearchOperation(ManagedOperation):
         super().__init__(*args, **kwargs)
         self.match_method = match_method
 
+    @property
+    def match_method(self) -> str:
+        return self._match_method
+
+    @match_method.setter
+    def match_method(self, match_method: str) -> None:
+        """Set the match method, binding is_match to the matching function so it does not dispatch on every call."""
+        if match_method == "feature":
+            self._match_fn = self.is_match_by_feature
+        elif match_method == "class":
+            self._match_fn = self.is_match_by_class
+        else:
+            self.error(f"Unknown match method {match_method}.")
+            raise ValueError(f"Unknown match method {match_method}.")
+        self._match_method = match_method
+
     def set_target_object_class(self, object_class: str):
         """Set the target object class for the search operation."""
         self.warn(f"Overwriting target object class from {self.object_class} to {object_class}.")
         self._object_class = object_class
         self._object_class_feature = None
 
+    def get_object_class_feature(self) -> torch.Tensor:
+        """Get the text feature for the target object class. Features are cached across operations, so the text encoder only runs once per class.
+
+        Returns:
+            torch.Tensor: the text feature for the object class
+        """
+        encoder = self.agent.get_encoder()
+        features = _text_feature_cache.get(encoder)
+        if features is None:
+            features = OrderedDict()
+            _text_feature_cache[encoder] = features
+        feature = features.get(self.object_class)
+        if feature is None:
+            feature = self.agent.encode_text(self.object_class)
+            features[self.object_class] = feature
+            if len(features) > _text_feature_cache_size:
+                features.popitem(last=False)
+        else:
+            features.move_to_end(self.object_class)
+        return feature
+
     def is_match_by_feature(self, instance: Instance) -> bool:
         """Check if the instance is a match for the target object class by comparing feature vectors.
 
@@ -67,29 +168,124 @@ class ManagedSearchOperation(ManagedOperation):
 
         # Compute the feature vector for the object if not saved
         if self._object_class_feature is None:
-            self._object_class_feature = self.agent.encode_text(self.object_class)
+            self._object_class_feature = self.get_object_class_feature()
         emb = instance.get_image_embedding(
             aggregation_method=self.aggregation_method, normalize=False
         ).to(self._object_class_feature.device)
         activation = torch.cosine_similarity(emb, self._object_class_feature, dim=-1)
-        print(
-            f" - Found instance {instance.global_id} with similarity {activation} to {self.object_class}."
+        logger.debug(
+            " - Found instance",
+            instance.global_id,
+            "with similarity",
+            activation,
+            "to",
+            self.object_class,
         )
         return activation > self.agent.feature_match_threshold
 
+    def match_instances_by_feature(self, instances: List[Instance]) -> List[bool]:
+        """Check a list of instances against the target object class by comparing feature vectors. All instances are scored with a single matrix multiply.
+
+        Args:
+            instances (List[Instance]): the instances to check
+
+        Returns:
+            List[bool]: for each instance, True if it is a match, False otherwise
+        """
+        if len(instances) == 0:
+            return []
+
+        # Compute the feature vector for the object if not saved
+        if self._object_class_feature is None:
+            self._object_class_feature = self.get_object_class_feature()
+        query = self._object_class_feature.reshape(-1)
+        embs = torch.stack(
+            [
+                instance.get_image_embedding(
+                    aggregation_method=self.aggregation_method, normalize=False
+                ).reshape(-1)
+                for instance in instances
+            ]
+        ).to(query.device)
+        score_features = (
+            _get_compiled_score_features() if self.compile_feature_scoring else _score_features
+        )
+        if self.half_precision_scoring and query.is_cuda:
+            embs = embs.to(torch.bfloat16)
+            query = query.to(torch.bfloat16)
+        activations = score_features(embs, query).float().cpu().tolist()
+        for instance, activation in zip(instances, activations):
+            logger.debug(
+                " - Found instance",
+                instance.global_id,
+                "with similarity",
+                activation,
+                "to",
+                self.object_class,
+            )
+        threshold = self.agent.feature_match_threshold
+        return [activation > threshold for activation in activations]
+
+    def match_instances(self, instances: List[Instance]) -> List[bool]:
+        """Check a list of instances against the target object class.
+
+        Args:
+            instances (List[Instance]): the instances to check
+
+        Returns:
+            List[bool]: for each instance, True if it is a match, False otherwise
+        """
+        names = None
+        if self.match_method == "class" or self.prefilter_by_name:
+            names = self.get_class_names(instances)
+            name_matches = [name is not None and self.is_name_match(name) for name in names]
+        if self.match_method == "class":
+            for instance, name in zip(instances, names):
+                logger.debug(" - Found instance", instance.global_id, "of class", name)
+            return name_matches
+        if names is None:
+            return self.match_instances_by_feature(instances)
+
+        # Only score the instances that survive the name check
+        candidates = [i for i, name_match in enumerate(name_matches) if name_match]
+        matches = [False] * len(instances)
+        scores = self.match_instances_by_feature([instances[i] for i in candidates])
+        for i, match in zip(candidates, scores):
+            matches[i] = match
+        return matches
+
+    def get_class_names(self, instances: List[Instance]) -> List[Optional[str]]:
+        """Look up the class names of a list of instances, resolving the vocabulary only once.
+
+        Args:
+            instances (List[Instance]): the instances to look up
+
+        Returns:
+            List[Optional[str]]: the class name of each instance, or None if it is not in the vocabulary
+        """
+        vocabulary = self.agent.semantic_sensor.current_vocabulary
+        if vocabulary is None:
+            return [None] * len(instances)
+        id_to_name = vocabulary.goal_id_to_goal_name
+        return [id_to_name.get(instance.get_category_id()) for instance in instances]
+
+    def is_match_by_class(self, instance: Instance) -> bool:
+        """Check if the instance is a match for the target object class by comparing class names.
+
+        Args:
+            instance (Instance): the instance to check
+
+        Returns:
+            bool: True if the instance is a match, False otherwise
+        """
+        # Lookup the class name and check if it matches our target
+        name = self.agent.semantic_sensor.get_class_name_for_id(instance.category_id)
+        logger.debug(" - Found instance", instance.global_id, "of class", name)
+        return self.is_name_match(name)
+
     def is_match(self, instance: Instance) -> bool:
         """Check if the instance is a match for the target object class."""
-        if self.match_method == "feature":
-            return self.is_match_by_feature(instance)
-        elif self.match_method == "class":
-            # Lookup the class name and check if it matches our target
-            name = self.agent.semantic_sensor.get_class_name_for_id(instance.category_id)
-            print(f" - Found instance {instance.global_id} of class {name}")
-            return self.is_name_match(name)
-        else:
-            self.error(f"Unknown match method {self.match_method}.")
-            raise ValueError(f"Unknown match method {self.match_method}.")
-        return False
+        return self._match_fn(instance)
 
     def is_name_match(self, name: str) -> bool:
         """Check if the name of the object is a match for the target object class. By default, we check if the object class is in the name of the object."""
@@ -119,18 +315,18 @@ class SearchForReceptacleOperation(ManagedSearchOperation):
         if self.object_class is None:
             self.set_target_object_class("box")
 
+        # Get the current location of the robot
+        start = self.robot.get_base_pose()
+
         if self.show_map_so_far:
             # This shows us what the robot has found so far
-            xyt = self.robot.get_base_pose()
             self.agent.get_voxel_map().show(
-                orig=np.zeros(3), xyt=xyt, footprint=self.robot_model.get_footprint()
+                orig=np.zeros(3), xyt=start, footprint=self.robot_model.get_footprint()
             )
 
         if self.show_instances_detected:
             self.show_instance_segmentation_image()
 
-        # Get the current location of the robot
-        start = self.robot.get_base_pose()
         if not self.navigation_space.is_valid(start):
             self.error(
                 "Robot is in an invalid configuration. It is probably too close to geometry, or localization has failed."
@@ -142,14 +338,18 @@ class SearchForReceptacleOperation(ManagedSearchOperation):
         # Check to see if we have a receptacle in the map
         instances = self.agent.get_voxel_map().instances.get_instances()
         print("Check explored instances for reachable receptacles:")
+        matches = self.match_instances(instances)
+        if self.show_instances_detected:
+            names = self.get_class_names(instances)
+        num_shown = 0
         for i, instance in enumerate(instances):
             # For debugging during exploration
-            if self.show_instances_detected:
-                name = self.agent.semantic_sensor.get_class_name_for_id(instance.category_id)
-                self.show_instance(instance, f"Instance {i} with name {name}")
+            if self.show_instances_detected and num_shown < self.max_instances_to_show:
+                self.show_instance(instance, f"Instance {i} with name {names[i]}")
+                num_shown += 1
 
             # Find the object we care about
-            if self.is_match(instance):
+            if matches[i]:
                 print(" - Found a matching instance. Try to plan to it...")
                 # Check to see if we can motion plan to box or not
                 plan = self.agent.plan_to_instance_for_manipulation(instance, start=start)
@@ -188,15 +388,13 @@ class SearchForReceptacleOperation(ManagedSearchOperation):
                 time.sleep(self.talk_t)
             self.set_status(status.SUCCEEDED)
             view = self.agent.current_receptacle.get_best_view()
-            image = Image.fromarray(view.get_image())
-            image.save("receptacle.png")
+            _save_image_async(view.get_image(), "receptacle.png")
             if self.show_map_so_far:
                 # This shows us what the robot has found so far
-                object_xyz = self.agent.current_receptacle.point_cloud.mean(axis=0).cpu().numpy()
-                xyt = self.robot.get_base_pose()
+                object_xyz = self.agent.current_receptacle.get_centroid()
                 self.agent.get_voxel_map().show(
                     orig=object_xyz,
-                    xyt=xyt,
+                    xyt=start,
                     footprint=self.robot_model.get_footprint(),
                     planner_visuals=False,
                 )
@@ -230,8 +428,6 @@ class SearchForObjectOnFloorOperation(ManagedSearchOperation):
             self.attempt("Will start searching for objects.")
             return True
 
-        return self.agent.current_receptacle is not None
-
     def run(self) -> None:
         self.intro("Find a reachable object on the floor.")
         self._successful = False
@@ -250,15 +446,15 @@ class SearchForObjectOnFloorOperation(ManagedSearchOperation):
             # Do not update until you are in nav posture
             self.update()
 
+        # Get the current location of the robot
+        start = self.robot.get_base_pose()
+
         if self.show_map_so_far:
             # This shows us what the robot has found so far
-            xyt = self.robot.get_base_pose()
             self.agent.get_voxel_map().show(
-                orig=np.zeros(3), xyt=xyt, footprint=self.robot_model.get_footprint()
+                orig=np.zeros(3), xyt=start, footprint=self.robot_model.get_footprint()
             )
 
-        # Get the current location of the robot
-        start = self.robot.get_base_pose()
         if not self.navigation_space.is_valid(start):
             self.error(
                 "Robot is in an invalid configuration. It is probably too close to geometry, or localization has failed."
@@ -266,12 +462,7 @@ class SearchForObjectOnFloorOperation(ManagedSearchOperation):
 
         if self.show_instances_detected:
             # Show the last instance image
-            import matplotlib
-
-            # TODO: why do we need to configure this every time
-            matplotlib.use("TkAgg")
-            import matplotlib.pyplot as plt
-
+            plt = _get_plt()
             plt.imshow(self.agent.get_voxel_map().observations[0].instance)
             plt.show()
 
@@ -280,23 +471,33 @@ class SearchForObjectOnFloorOperation(ManagedSearchOperation):
 
         # Compute scene graph from instance memory so that we can use it
         scene_graph = self.agent.get_scene_graph()
+        on_floor = scene_graph.get_objects_on("floor")
 
-        receptacle_options: List[Instance] = []
         print(f"Check explored instances for reachable {self.object_class} instances:")
+        # Only score instances we could still reach
+        reachable = [not self.agent.is_instance_unreachable(instance) for instance in instances]
+        candidates = [i for i, is_reachable in enumerate(reachable) if is_reachable]
+        matches = [False] * len(instances)
+        for i, match in zip(candidates, self.match_instances([instances[i] for i in candidates])):
+            matches[i] = match
+        names = self.get_class_names(instances)
+        num_shown = 0
         for i, instance in enumerate(instances):
-            name = self.agent.semantic_sensor.get_class_name_for_id(instance.category_id)
-            print(f" - Found instance {i} with name {name} and global id {instance.global_id}.")
+            name = names[i]
+            logger.debug(
+                " - Found instance", i, "with name", name, "and global id", instance.global_id
+            )
 
-            if self.agent.is_instance_unreachable(instance):
-                print(" - Instance is unreachable.")
+            if not reachable[i]:
+                logger.debug(" - Instance is unreachable.")
                 continue
 
-            if self.show_instances_detected:
+            if self.show_instances_detected and num_shown < self.max_instances_to_show:
                 self.show_instance(instance, f"Instance {i} with name {name}")
+                num_shown += 1
 
-            if self.is_match(instance):
-                relations = scene_graph.get_matching_relations(instance.global_id, "floor", "on")
-                if len(relations) > 0:
+            if matches[i]:
+                if instance.global_id in on_floor:
                     # We found a matching relation!
                     print(f" - Found a toy on the floor at {instance.get_best_view().get_pose()}.")
 
@@ -330,15 +531,13 @@ class SearchForObjectOnFloorOperation(ManagedSearchOperation):
                 self.agent.robot_say(f"I found a {self.sayable_object_class} that I can reach!")
                 time.sleep(self.talk_t)
             view = self.agent.current_object.get_best_view()
-            image = Image.fromarray(view.get_image())
-            image.save("object.png")
+            _save_image_async(view.get_image(), "object.png")
             if self.show_map_so_far:
                 # This shows us what the robot has found so far
-                object_xyz = self.agent.current_object.point_cloud.mean(axis=0).cpu().numpy()
-                xyt = self.robot.get_base_pose()
+                object_xyz = self.agent.current_object.get_centroid()
                 self.agent.get_voxel_map().show(
                     orig=object_xyz,
-                    xyt=xyt,
+                    xyt=start,
                     footprint=self.robot_model.get_footprint(),
                     planner_visuals=False,
                 )
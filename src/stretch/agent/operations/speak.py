@@ -32,17 +32,15 @@ class SpeakOperation(ManagedOperation):
         self,
     ):
         """
-        Speaks a message
-
-        Parameters:
-            message (str): The message to speak.
+        Speaks the message set by configure(). Failures are reported through was_successful().
         """
         try:
             self.agent.tts.say_async(self._message)
             self._success = True
         except Exception as e:
             self._success = False
-            self._error = e
+            # Keep the error, but not the frames of the failed synthesis
+            self._error = e.with_traceback(None)
 
     def was_successful(self) -> bool:
         """Return true if successful"""
@@ -9,12 +9,17 @@
 
 # (c) 2024 Hello Robot under MIT license
 
+import atexit
+import copy
+import math
+import pickle
 import sys
 import threading
 import time
 import timeit
+from contextlib import contextmanager
 from threading import Lock
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import click
 import numpy as np
@@ -38,7 +43,6 @@ from stretch.utils.geometry import (
 from stretch.utils.image import Camera
 from stretch.utils.logger import Logger
 from stretch.utils.memory import lookup_address
-from stretch.utils.point_cloud import show_point_cloud
 
 logger = Logger(__name__)
 
@@ -47,6 +51,11 @@ logger = Logger(__name__)
 # faulthandler.enable()
 
 
+def _angle_dist(a: float, b: float) -> float:
+    """Absolute angle between two headings in [0, pi]. Scalar equivalent of angle_difference for the wait loops."""
+    return abs((a - b + math.pi) % (2 * math.pi) - math.pi)
+
+
 class HomeRobotZmqClient(AbstractRobotClient):
 
     update_base_pose_from_full_obs: bool = False
@@ -57,6 +66,21 @@ class HomeRobotZmqClient(AbstractRobotClient):
     _head_tilt_min = -np.pi
     _head_tilt_max = 0
 
+    # Kernel socket buffer size in bytes for the ZMQ TCP connections
+    _socket_buffer_size = 4 * 1024 * 1024
+
+    # Minimum time in seconds between status prints in wait loops
+    _wait_print_interval = 0.1
+    # Print receive timing every this many observations when verbose
+    num_obs_report_steps: int = 30
+
+    # How long the receive threads block before checking whether they should stop
+    _recv_poll_timeout_ms = 50
+
+    # Action fields the robot can execute together in one message; see batch()
+    _batchable_keys = ("joint", "gripper", "head_to")
+    _batchable_flags = ("manip_blocking", "gripper_blocking")
+
     def _create_recv_socket(
         self,
         port: int,
@@ -70,6 +94,11 @@ class HomeRobotZmqClient(AbstractRobotClient):
         recv_socket.setsockopt(zmq.SNDHWM, 1)
         recv_socket.setsockopt(zmq.RCVHWM, 1)
         recv_socket.setsockopt(zmq.CONFLATE, 1)
+        # Low-latency options: do not hold pending messages on close, detect dead peers, and give
+        # the kernel room for a full RGB-D frame
+        recv_socket.setsockopt(zmq.LINGER, 0)
+        recv_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        recv_socket.setsockopt(zmq.RCVBUF, self._socket_buffer_size)
 
         ip_address = lookup_address(robot_ip, use_remote_computer)
         if ip_address is None:
@@ -87,6 +116,22 @@ class HomeRobotZmqClient(AbstractRobotClient):
 
         return recv_socket
 
+    def _recv_pyobj(self, socket: zmq.Socket) -> Any:
+        """Receive a pickled message. Unpickles straight from the ZMQ frame, instead of copying the whole payload into a bytes object first as recv_pyobj does.
+
+        Waits at most _recv_poll_timeout_ms for a message, so the spin threads can check self._finish even when the robot stops publishing.
+
+        Args:
+            socket (zmq.Socket): the socket to receive from
+
+        Returns:
+            Any: the unpickled message, or None if nothing arrived before the timeout
+        """
+        if not socket.poll(self._recv_poll_timeout_ms, zmq.POLLIN):
+            return None
+        frame = socket.recv(zmq.NOBLOCK, copy=False)
+        return pickle.loads(frame.buffer)
+
     def get_zmq_context(self) -> zmq.Context:
         """Get the ZMQ context for the client.
 
@@ -115,6 +160,7 @@ class HomeRobotZmqClient(AbstractRobotClient):
         enable_rerun_server: bool = True,
         resend_all_actions: bool = False,
         publish_observations: bool = False,
+        depth_decode: str = "full",
     ):
         """
         Create a client to communicate with the robot over ZMQ.
@@ -130,9 +176,17 @@ class HomeRobotZmqClient(AbstractRobotClient):
             grasp_frame: The frame to use for grasping
             ee_link_name: The name of the end effector link
             manip_mode_controlled_joints: The joints to control in manipulation mode
+            depth_decode: "full" to decode head depth and compute xyz for every observation, or "skip" to leave depth and xyz as None when only RGB and pose are needed
         """
+        if depth_decode not in ("full", "skip"):
+            raise ValueError(f"Unknown depth_decode option: {depth_decode}")
+        self._depth_decode = depth_decode
         self.recv_port = recv_port
         self.send_port = send_port
+        self._state_callbacks: List[Callable[[Dict[str, Any]], None]] = []
+        # Head camera model for depth_to_xyz; kept across restarts and rebuilt if intrinsics change
+        self._camera = None
+        self._camera_key = None
         self.reset()
 
         # Load parameters
@@ -186,9 +240,12 @@ class HomeRobotZmqClient(AbstractRobotClient):
         )
 
         # Create ZMQ sockets
-        self.context = zmq.Context()
+        # A second I/O thread keeps the large observation stream from delaying state messages
+        self.context = zmq.Context(io_threads=2)
 
         print("-------- HOME-ROBOT ROS2 ZMQ CLIENT --------")
+        # One socket per stream on purpose: each is CONFLATE so it only holds the latest message,
+        # and a shared socket would let a large observation displace the newest state message
         self.recv_socket = self._create_recv_socket(
             self.recv_port, robot_ip, use_remote_computer, message_type="observations"
         )
@@ -200,9 +257,15 @@ class HomeRobotZmqClient(AbstractRobotClient):
         )
 
         # Send actions back to the robot for execution
+        # Actions are small, latency-sensitive commands: queue only on a completed connection and
+        # keep at most one pending message. The receive sockets stay throughput-oriented.
         self.send_socket = self.context.socket(zmq.PUB)
+        self.send_socket.setsockopt(zmq.IMMEDIATE, 1)
         self.send_socket.setsockopt(zmq.SNDHWM, 1)
         self.send_socket.setsockopt(zmq.RCVHWM, 1)
+        self.send_socket.setsockopt(zmq.LINGER, 0)
+        self.send_socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+        self.send_socket.setsockopt(zmq.SNDBUF, self._socket_buffer_size)
 
         self.send_address = (
             lookup_address(robot_ip, use_remote_computer) + ":" + str(self.send_port)
@@ -212,19 +275,27 @@ class HomeRobotZmqClient(AbstractRobotClient):
         self.send_socket.connect(self.send_address)
         print("...connected.")
 
-        self._obs_lock = Lock()
+        # Observation and state locks are conditions, so waiters wake up as soon as a message lands
+        self._obs_lock = threading.Condition()
         self._act_lock = Lock()
-        self._state_lock = Lock()
+        self._state_lock = threading.Condition()
         self._servo_lock = Lock()
         self._send_lock = Lock()
 
+        # Latest undecoded observation, handed from blocking_spin to blocking_decode
+        self._raw_obs = None
+        self._raw_obs_cv = threading.Condition()
+
         if enable_rerun_server:
             from stretch.visualization.rerun import RerunVisualizer
 
             self._rerun = RerunVisualizer()
         else:
             self._rerun = None
-            self._rerun_thread = None
+
+        # Make sure threads and sockets are shut down when the interpreter exits, e.g. on Ctrl-C
+        self._stopped = False
+        atexit.register(self.stop)
 
         if start_immediately:
             self.start()
@@ -261,13 +332,10 @@ class HomeRobotZmqClient(AbstractRobotClient):
 
     def get_joint_state(self, timeout: float = 5.0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
         """Get the current joint positions, velocities, and efforts"""
-        t0 = timeit.default_timer()
         with self._state_lock:
-            while self._state is None:
-                time.sleep(1e-4)
-                if timeit.default_timer() - t0 > timeout:
-                    logger.error("Timeout waiting for state message")
-                    return None, None, None
+            if not self._state_lock.wait_for(lambda: self._state is not None, timeout=timeout):
+                logger.error("Timeout waiting for state message")
+                return None, None, None
             joint_positions = self._state["joint_positions"]
             joint_velocities = self._state["joint_velocities"]
             joint_efforts = self._state["joint_efforts"]
@@ -275,13 +343,10 @@ class HomeRobotZmqClient(AbstractRobotClient):
 
     def get_joint_positions(self, timeout: float = 5.0) -> np.ndarray:
         """Get the current joint positions"""
-        t0 = timeit.default_timer()
         with self._state_lock:
-            while self._state is None:
-                time.sleep(1e-4)
-                if timeit.default_timer() - t0 > timeout:
-                    logger.error("Timeout waiting for state message")
-                    return None
+            if not self._state_lock.wait_for(lambda: self._state is not None, timeout=timeout):
+                logger.error("Timeout waiting for state message")
+                return None
             joint_positions = self._state["joint_positions"]
         return joint_positions
 
@@ -292,13 +357,10 @@ class HomeRobotZmqClient(AbstractRobotClient):
 
     def get_joint_velocities(self, timeout: float = 5.0) -> np.ndarray:
         """Get the current joint velocities"""
-        t0 = timeit.default_timer()
         with self._state_lock:
-            while self._state is None:
-                time.sleep(1e-4)
-                if timeit.default_timer() - t0 > timeout:
-                    logger.error("Timeout waiting for state message")
-                    return None
+            if not self._state_lock.wait_for(lambda: self._state is not None, timeout=timeout):
+                logger.error("Timeout waiting for state message")
+                return None
             joint_velocities = self._state["joint_velocities"]
         return joint_velocities
 
@@ -312,13 +374,10 @@ class HomeRobotZmqClient(AbstractRobotClient):
             np.ndarray: The joint efforts as an array of floats
         """
 
-        t0 = timeit.default_timer()
         with self._state_lock:
-            while self._state is None:
-                time.sleep(1e-4)
-                if timeit.default_timer() - t0 > timeout:
-                    logger.error("Timeout waiting for state message")
-                    return None
+            if not self._state_lock.wait_for(lambda: self._state is not None, timeout=timeout):
+                logger.error("Timeout waiting for state message")
+                return None
             joint_efforts = self._state["joint_efforts"]
         return joint_efforts
 
@@ -331,24 +390,19 @@ class HomeRobotZmqClient(AbstractRobotClient):
         Returns:
             np.ndarray: The base pose as [x, y, theta]
         """
-        t0 = timeit.default_timer()
         if self.update_base_pose_from_full_obs:
             with self._obs_lock:
-                while self._obs is None:
-                    time.sleep(0.01)
-                    if timeit.default_timer() - t0 > timeout:
-                        logger.error("Timeout waiting for observation")
-                        return None
+                if not self._obs_lock.wait_for(lambda: self._obs is not None, timeout=timeout):
+                    logger.error("Timeout waiting for observation")
+                    return None
                 gps = self._obs["gps"]
                 compass = self._obs["compass"]
                 xyt = np.concatenate([gps, compass], axis=-1)
         else:
             with self._state_lock:
-                while self._state is None:
-                    time.sleep(1e-4)
-                    if timeit.default_timer() - t0 > timeout:
-                        logger.error("Timeout waiting for state message")
-                        return None
+                if not self._state_lock.wait_for(lambda: self._state is not None, timeout=timeout):
+                    logger.error("Timeout waiting for state message")
+                    return None
                 xyt = self._state["base_pose"]
         return xyt
 
@@ -739,11 +793,18 @@ class HomeRobotZmqClient(AbstractRobotClient):
         """Reset everything in the robot's internal state"""
         self._control_mode = None
         self._obs = None  # Full observation includes high res images and camera pose, no EE camera
+        self._observation = None  # Observations object built from self._obs
+        self._obs_step = None  # Step of self._obs, kept as an attribute for the up-to-date checks
         self._pose_graph = None
         self._state = None  # Low level state includes joint angles and base XYT
+        self._state_seq = 0  # Number of state messages received
         self._servo = None  # Visual servoing state includes smaller images
         self._thread = None
+        self._decode_thread = None
         self._state_thread = None
+        self._servo_thread = None
+        self._rerun_thread = None
+        self._batch_local = threading.local()  # Pending action of each thread inside batch()
         self._finish = False
         self._last_step = -1
 
@@ -1006,6 +1067,7 @@ class HomeRobotZmqClient(AbstractRobotClient):
         """
         t0 = timeit.default_timer()
         mode_t0 = None
+        resend_t = None
         while True:
             with self._state_lock:
                 if verbose:
@@ -1018,9 +1080,14 @@ class HomeRobotZmqClient(AbstractRobotClient):
             # This is to handle network delays
             if mode_t0 is not None and timeit.default_timer() - mode_t0 > time_required:
                 break
-            if resend_action is not None:
-                self.send_socket.send_pyobj(resend_action)
-            time.sleep(0.1)
+            if resend_action is not None and (
+                resend_t is None or timeit.default_timer() - resend_t > 0.1
+            ):
+                self.send_message(resend_action)
+                resend_t = timeit.default_timer()
+            # Wake up on the next state message instead of polling
+            with self._state_lock:
+                self._state_lock.wait(timeout=0.01)
             t1 = timeit.default_timer()
             if t1 - t0 > timeout:
                 raise RuntimeError(f"Timeout waiting for mode {mode}: {t1 - t0} seconds")
@@ -1066,25 +1133,36 @@ class HomeRobotZmqClient(AbstractRobotClient):
             min_steps_not_moving = self._min_steps_not_moving
         t0 = timeit.default_timer()
         close_to_goal = False
+        seen_state_seq = -1
+        last_print_t = 0.0
 
         while True:
+            # Status messages in this loop are printed at most once per _wait_print_interval
+            print_now = timeit.default_timer() - last_print_t > self._wait_print_interval
+            if print_now:
+                last_print_t = timeit.default_timer()
 
-            # Minor delay at the end - give it time to get new messages
-            time.sleep(0.01)
+            # Block until a state message we have not looked at yet arrives, so each one is
+            # processed exactly once
+            with self._state_lock:
+                self._state_lock.wait_for(lambda: self._state_seq > seen_state_seq, timeout=0.1)
+                seen_state_seq = self._state_seq
 
             if not self.is_up_to_date():
-                if verbose:
+                if verbose and print_now:
                     print("Waiting for client to receive and process action")
                 continue
 
             with self._state_lock:
                 if self._state is None:
-                    print("waiting for obs")
+                    if print_now:
+                        print("waiting for obs")
                     continue
 
             with self._obs_lock:
                 if self._obs is None:
-                    print("waiting for obs")
+                    if print_now:
+                        print("waiting for obs")
                     continue
 
             xyt = self.get_base_pose()
@@ -1096,10 +1174,14 @@ class HomeRobotZmqClient(AbstractRobotClient):
                 t0 = timeit.default_timer()
                 continue
 
-            moved_dist = np.linalg.norm(pos - last_pos) if last_pos is not None else float("inf")
-            angle_dist = angle_difference(ang, last_ang) if last_ang is not None else float("inf")
+            moved_dist = (
+                math.hypot(pos[0] - last_pos[0], pos[1] - last_pos[1])
+                if last_pos is not None
+                else float("inf")
+            )
+            angle_dist = _angle_dist(ang, last_ang) if last_ang is not None else float("inf")
             if goal_angle is not None:
-                angle_dist_to_goal = angle_difference(ang, goal_angle)
+                angle_dist_to_goal = _angle_dist(ang, goal_angle)
                 at_goal = angle_dist_to_goal < goal_angle_threshold
             else:
                 at_goal = True
@@ -1127,7 +1209,7 @@ class HomeRobotZmqClient(AbstractRobotClient):
             last_ang = ang
             last_obs_t = obs_t
             close_to_goal = at_goal
-            if verbose:
+            if verbose and print_now:
                 print(
                     f"Waiting for step={block_id} {self._last_step} prev={self._last_step} at {pos} moved {moved_dist:0.04f} angle {angle_dist:0.04f} not_moving {not_moving_count} at_goal {self._state['at_goal']}"
                 )
@@ -1166,29 +1248,62 @@ class HomeRobotZmqClient(AbstractRobotClient):
         """return a model of the robot for planning"""
         return self._robot_model
 
-    def _update_obs(self, obs):
+    def _make_observation(self, obs: dict, seq_id: int) -> Observations:
+        """Build the Observations object for a decoded observation message.
+
+        Args:
+            obs (dict): decoded observation message from the robot
+            seq_id (int): sequence number of the message
+
+        Returns:
+            Observations: the observation object handed out by get_observation
+        """
+        observation = Observations(
+            gps=obs["gps"],
+            compass=obs["compass"],
+            rgb=obs["rgb"],
+            depth=obs["depth"],
+            xyz=obs["xyz"],
+            lidar_points=obs["lidar_points"],
+            lidar_timestamp=obs["lidar_timestamp"],
+        )
+        observation.joint = obs.get("joint", None)
+        observation.ee_pose = obs.get("ee_pose", None)
+        observation.camera_K = obs.get("camera_K", None)
+        observation.camera_pose = obs.get("camera_pose", None)
+        observation.seq_id = seq_id
+        return observation
+
+    def _update_obs(self, obs, observation: Optional[Observations] = None):
         """Update observation internally with lock"""
         with self._obs_lock:
             self._obs = obs
+            self._observation = observation
+            self._obs_step = obs["step"]
             self._last_step = obs["step"]
             if self._iter <= 0:
                 self._iter = max(self._last_step, self._iter)
+            self._obs_lock.notify_all()
 
     def is_up_to_date(self):
         """Check if the robot is up to date with the latest observation"""
         with self._obs_lock:
             # print("obs", self._obs["step"], self._last_step, self._iter)
             obs_ok = (
-                self._obs is not None
-                and self._obs["step"] >= self._last_step
-                and self._obs["step"] >= self._iter - 1
+                self._obs_step is not None
+                and self._obs_step >= self._last_step
+                and self._obs_step >= self._iter - 1
             )
         return obs_ok
 
     def send_message(self, message: dict):
         """Send a message to the robot"""
+        self._send_serialized(pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def _send_serialized(self, data: bytes):
+        """Send an already pickled message to the robot. Useful when the same message is resent, so it is only serialized once."""
         with self._send_lock:
-            self.send_socket.send_pyobj(message)
+            self.send_socket.send(data)
 
     def _update_pose_graph(self, obs):
         """Update internal pose graph"""
@@ -1199,7 +1314,7 @@ class HomeRobotZmqClient(AbstractRobotClient):
     def out_of_date(self):
         """Check if the robot is out of date with the latest observation. This is used to determine if we should wait for the robot to catch up."""
         with self._obs_lock:
-            obs_ood = self._obs is not None and self._obs["step"] < self._last_step
+            obs_ood = self._obs_step is not None and self._obs_step < self._last_step
         with self._state_lock:
             state_ood = self._state is not None and self._state["step"] < self._last_step
         return obs_ood or state_ood
@@ -1222,6 +1337,22 @@ class HomeRobotZmqClient(AbstractRobotClient):
             self._state = state
             self._control_mode = state["control_mode"]
             self._at_goal = state["at_goal"]
+            self._state_seq += 1
+            self._state_lock.notify_all()
+        for callback in self._state_callbacks:
+            # An exception here would otherwise kill the state receive thread
+            try:
+                callback(state)
+            except Exception as e:
+                logger.error(f"Error in state callback {callback}: {e}")
+
+    def register_state_callback(self, callback: Callable[[Dict[str, Any]], None]) -> None:
+        """Register a function to call on every new low level state message, e.g. to read joint states without polling. Callbacks run on the state receive thread, so they should return quickly.
+
+        Args:
+            callback (Callable[[dict], None]): called with the state message dict
+        """
+        self._state_callbacks.append(callback)
 
     def at_goal(self) -> bool:
         """Check if the robot is at the goal.
@@ -1253,31 +1384,32 @@ class HomeRobotZmqClient(AbstractRobotClient):
         self.send_action(next_action)
 
     def get_observation(self, max_iter: int = 5):
-        """Get the current observation. This uses the FULL observation track. Expected to be syncd with RGBD."""
+        """Get the current observation. This uses the FULL observation track. Expected to be syncd with RGBD.
+
+        The Observations object is built once per frame; each caller gets a shallow copy, so that
+        setting fields on it (e.g. semantic segmentation) does not change what other callers see.
+        Image arrays are shared and should be treated as read-only.
+        """
         iteration = 0
         while not self.is_up_to_date() and iteration < max_iter:
             if self.is_up_to_date():
                 iteration += 1
             time.sleep(0.1)
         time.sleep(0.1)
-        with self._obs_lock:
-            if self._obs is None:
-                return None
-            observation = Observations(
-                gps=self._obs["gps"],
-                compass=self._obs["compass"],
-                rgb=self._obs["rgb"],
-                depth=self._obs["depth"],
-                xyz=self._obs["xyz"],
-                lidar_points=self._obs["lidar_points"],
-                lidar_timestamp=self._obs["lidar_timestamp"],
-            )
-            observation.joint = self._obs.get("joint", None)
-            observation.ee_pose = self._obs.get("ee_pose", None)
-            observation.camera_K = self._obs.get("camera_K", None)
-            observation.camera_pose = self._obs.get("camera_pose", None)
-            observation.seq_id = self._seq_id
-            return observation
+        # Fast path: the decode thread publishes a complete object with one reference store
+        observation = self._observation
+        if observation is None:
+            with self._obs_lock:
+                if self._obs is None:
+                    return None
+                if self._observation is None:
+                    self._observation = self._make_observation(self._obs, self._seq_id)
+                observation = self._observation
+        observation = copy.copy(observation)
+        if observation.task_observations is not None:
+            # Updated in place by the semantic sensor
+            observation.task_observations = dict(observation.task_observations)
+        return observation
 
     def get_images(self, compute_xyz=False):
         """Get the current RGB and depth images from the robot.
@@ -1385,8 +1517,8 @@ class HomeRobotZmqClient(AbstractRobotClient):
             # Loop until we get there (or time out)
             t1 = timeit.default_timer()
             curr = self.get_base_pose()
-            pos_err = np.linalg.norm(xy - curr[:2])
-            rot_err = np.abs(angle_difference(curr[-1], xyt[2]))
+            pos_err = math.hypot(xy[0] - curr[0], xy[1] - curr[1])
+            rot_err = _angle_dist(curr[-1], xyt[2])
             # TODO: code for debugging slower rotations
             # if pos_err < pos_err_threshold and rot_err > rot_err_threshold:
             #     print(f"{curr[-1]}, {xyt[2]}, {rot_err}")
@@ -1418,6 +1550,52 @@ class HomeRobotZmqClient(AbstractRobotClient):
         next_action = {"base_velocity": {"v": forward, "w": rotational}}
         self.send_action(next_action)
 
+    @contextmanager
+    def batch(self):
+        """Coalesce non-blocking joint, gripper and head commands into a single action, sent when the block exits. Later commands overwrite earlier ones for the same field. Any other action (navigation, mode switches, blocking commands) is sent immediately as usual.
+
+        Example:
+            with robot.batch():
+                robot.head_to(0, -0.5, blocking=False)
+                robot.gripper_to(0.5, blocking=False)
+
+        Only commands sent from the thread that opened the batch are coalesced. A nested batch()
+        adds its commands to the outer one, which sends them all when it exits.
+        """
+        if self._get_batched_action() is not None:
+            yield
+            return
+        self._batch_local.action = {}
+        try:
+            yield
+        finally:
+            action, self._batch_local.action = self._batch_local.action, None
+            if action:
+                self._flush_batch(action)
+
+    def _get_batched_action(self) -> Optional[Dict[str, Any]]:
+        """Pending action of the current thread's batch, or None outside batch()."""
+        return getattr(self._batch_local, "action", None)
+
+    def _can_batch(self, action: Dict[str, Any]) -> bool:
+        """Check if an action only touches fields that can be merged into a batch."""
+        has_command = False
+        for key, value in action.items():
+            if key in self._batchable_keys:
+                has_command = True
+            elif key not in self._batchable_flags or value:
+                return False
+        return has_command
+
+    def _flush_batch(self, action: Dict[str, Any]) -> None:
+        """Send a coalesced batch of commands."""
+        if "joint" not in action and "head_to" in action and "gripper" in action:
+            # The robot only executes head and gripper together as part of a joint command
+            self.send_action({"head_to": action["head_to"], "manip_blocking": False})
+            self.send_action({"gripper": action["gripper"], "gripper_blocking": False})
+        else:
+            self.send_action(action)
+
     def send_action(
         self,
         next_action: Dict[str, Any],
@@ -1434,8 +1612,16 @@ class HomeRobotZmqClient(AbstractRobotClient):
             reliable (bool): whether to resend the action if it is not received
 
         Returns:
-            dict: copy of the action that was sent to the robot.
+            dict: copy of the action that was sent to the robot. Inside batch(), a command that was
+            merged into the batch has not been sent yet, so it is returned as given, without a step.
         """
+        batched_action = self._get_batched_action()
+        if batched_action is not None and reliable and self._can_batch(next_action):
+            # Inside batch(): merge the command and send it when the block exits. Unreliable
+            # sends are not merged, since the batch is flushed with a reliable send.
+            batched_action.update(next_action)
+            return next_action
+
         if verbose:
             logger.info("-> sending", next_action)
         blocking = False
@@ -1447,12 +1633,16 @@ class HomeRobotZmqClient(AbstractRobotClient):
             next_action["step"] = block_id
             self._iter = block_id + 1
 
-            self.send_message(next_action)
+            data = pickle.dumps(next_action, protocol=pickle.HIGHEST_PROTOCOL)
+            self._send_serialized(data)
 
+            # The robot acks by echoing the step back in its state messages, so wake up as soon
+            # as that arrives and only resend if it has not shown up within 10 ms
             while reliable and self._last_step < block_id:
-                # print(next_action)
-                self.send_message(next_action)
-                time.sleep(0.01)
+                with self._state_lock:
+                    if self._state_lock.wait_for(lambda: self._last_step >= block_id, timeout=0.01):
+                        break
+                self._send_serialized(data)
 
             # For tracking goal
             if "xyt" in next_action:
@@ -1467,47 +1657,100 @@ class HomeRobotZmqClient(AbstractRobotClient):
         return current_action
 
     def blocking_spin(self, verbose: bool = False, visualize: bool = False):
-        """Listen for incoming observations and update internal state"""
+        """Listen for incoming observations and hand them to the decode thread. Decoding happens in blocking_decode, so this thread only waits on the network.
+
+        Args:
+            verbose (bool): whether to print out debug information
+            visualize (bool): unused; kept for compatibility
+        """
         sum_time = 0.0
         steps = 0
         t0 = timeit.default_timer()
-        camera = None
-        shown_point_cloud = visualize
 
         while not self._finish:
 
-            output = self.recv_socket.recv_pyobj()
+            output = self._recv_pyobj(self.recv_socket)
             if output is None:
                 continue
 
-            self._seq_id += 1
-            output["rgb"] = compression.from_jpg(output["rgb"])
-            compressed_depth = output["depth"]
-            depth = compression.from_jp2(compressed_depth) / 1000
-            output["depth"] = depth
+            # Only the latest message is kept, matching the CONFLATE socket
+            with self._raw_obs_cv:
+                self._raw_obs = output
+                self._raw_obs_cv.notify()
 
-            if camera is None:
-                camera = Camera.from_K(
-                    output["camera_K"], output["rgb_height"], output["rgb_width"]
+            t1 = timeit.default_timer()
+            dt = t1 - t0
+            sum_time += dt
+            steps += 1
+            if verbose and steps % self.num_obs_report_steps == 1:
+                logger.info(
+                    f"time taken = {dt} avg = {sum_time/steps} keys={[k for k in output.keys()]}"
                 )
+            t0 = timeit.default_timer()
 
-            output["xyz"] = camera.depth_to_xyz(output["depth"])
+    def _get_camera(self, obs: dict) -> Camera:
+        """Get the head camera model for an observation, only rebuilding it when the intrinsics or image size change.
 
-            if visualize and not shown_point_cloud:
-                show_point_cloud(output["xyz"], output["rgb"] / 255.0, orig=np.zeros(3))
-                shown_point_cloud = True
+        Args:
+            obs (dict): observation message with camera_K, rgb_height and rgb_width
+
+        Returns:
+            Camera: the camera model
+        """
+        camera_K = obs["camera_K"]
+        key = (camera_K.tobytes(), obs["rgb_height"], obs["rgb_width"])
+        if self._camera is None or key != self._camera_key:
+            self._camera = Camera.from_K(camera_K, obs["rgb_height"], obs["rgb_width"])
+            self._camera_key = key
+        return self._camera
 
-            self._update_obs(output)
+    def blocking_decode(self, verbose: bool = False):
+        """Decode observations received by blocking_spin and update internal state. Runs in its own thread so that decoding the images and computing xyz overlaps with receiving the next message.
+
+        Args:
+            verbose (bool): whether to print out debug information
+        """
+        sum_time = 0.0
+        steps = 0
+
+        while not self._finish:
+            with self._raw_obs_cv:
+                self._raw_obs_cv.wait_for(lambda: self._raw_obs is not None, timeout=0.1)
+                output = self._raw_obs
+                self._raw_obs = None
+            if output is None:
+                continue
+
+            t0 = timeit.default_timer()
+            self._seq_id += 1
+            # The per-frame work below is all whole-array C code: cv2.imdecode and the numpy
+            # ufuncs in depth_to_xyz release the GIL, so it already overlaps with the other threads
+            output["rgb"] = compression.from_jpg(output["rgb"])
+            if self._depth_decode == "skip":
+                # Depth decoding is the most expensive part of the frame; skip it if unused
+                output["depth"] = None
+                output["xyz"] = None
+            else:
+                compressed_depth = output["depth"]
+                # Millimeters to meters, converting straight from uint16 to float32 in one pass
+                depth = np.divide(
+                    compression.from_jp2(compressed_depth), np.float32(1000), dtype=np.float32
+                )
+                output["depth"] = depth
+
+                output["xyz"] = self._get_camera(output).depth_to_xyz(output["depth"])
+
+            # Built once per frame here rather than on every get_observation call
+            self._update_obs(output, self._make_observation(output, self._seq_id))
             self._update_pose_graph(output)
 
             t1 = timeit.default_timer()
             dt = t1 - t0
             sum_time += dt
             steps += 1
-            if verbose:
-                print("Control mode:", self._control_mode)
-                print(f"time taken = {dt} avg = {sum_time/steps} keys={[k for k in output.keys()]}")
-            t0 = timeit.default_timer()
+            if verbose and steps % self.num_obs_report_steps == 1:
+                logger.info("Control mode:", self._control_mode)
+                logger.info(f"[DECODE] time taken = {dt} avg = {sum_time/steps}")
 
     def update_servo(self, message):
         """Servo messages"""
@@ -1518,7 +1761,8 @@ class HomeRobotZmqClient(AbstractRobotClient):
         if "ee_cam/color_image" in message:
             color_image = compression.from_jpg(message["ee_cam/color_image"])
             depth_image = compression.from_jp2(message["ee_cam/depth_image"])
-            depth_image = depth_image / 1000
+            # Millimeters to meters, converting straight from uint16 to float32 in one pass
+            depth_image = np.divide(depth_image, np.float32(1000), dtype=np.float32)
         else:
             color_image = None
             depth_image = None
@@ -1529,35 +1773,37 @@ class HomeRobotZmqClient(AbstractRobotClient):
         head_depth_image = compression.from_jp2(message["head_cam/depth_image"]) / 1000
         head_image_scaling = message["head_cam/image_scaling"]
         joint = message["robot/config"]
-        with self._servo_lock and self._state_lock:
-            observation = Observations(
-                gps=self._state["base_pose"][:2],
-                compass=self._state["base_pose"][2],
-                rgb=head_color_image,
-                depth=head_depth_image,
-                xyz=None,
-                ee_rgb=color_image,
-                ee_depth=depth_image,
-                ee_xyz=None,
-                joint=joint,
-            )
+        with self._state_lock:
+            base_pose = self._state["base_pose"]
+        observation = Observations(
+            gps=base_pose[:2],
+            compass=base_pose[2],
+            rgb=head_color_image,
+            depth=head_depth_image,
+            xyz=None,
+            ee_rgb=color_image,
+            ee_depth=depth_image,
+            ee_xyz=None,
+            joint=joint,
+        )
 
-            # We may not have the camera information yet
-            # Some robots do not have the d405
-            if "ee_cam/depth_camera_K" in message:
-                observation.ee_camera_K = message["ee_cam/depth_camera_K"]
-                observation.ee_camera_pose = message["ee_cam/pose"]
-                observation.ee_depth_scaling = message["ee_cam/image_scaling"]
-
-            observation.ee_pose = message["ee/pose"]
-            observation.depth_scaling = message["head_cam/depth_scaling"]
-            observation.camera_K = message["head_cam/depth_camera_K"]
-            observation.camera_pose = message["head_cam/pose"]
-            if "is_simulation" in message:
-                observation.is_simulation = message["is_simulation"]
-            else:
-                observation.is_simulation = False
-            self._servo = observation
+        # We may not have the camera information yet
+        # Some robots do not have the d405
+        if "ee_cam/depth_camera_K" in message:
+            observation.ee_camera_K = message["ee_cam/depth_camera_K"]
+            observation.ee_camera_pose = message["ee_cam/pose"]
+            observation.ee_depth_scaling = message["ee_cam/image_scaling"]
+
+        observation.ee_pose = message["ee/pose"]
+        observation.depth_scaling = message["head_cam/depth_scaling"]
+        observation.camera_K = message["head_cam/depth_camera_K"]
+        observation.camera_pose = message["head_cam/pose"]
+        if "is_simulation" in message:
+            observation.is_simulation = message["is_simulation"]
+        else:
+            observation.is_simulation = False
+        # Publish with a single reference store; readers do not need to take a lock
+        self._servo = observation
 
     def get_servo_observation(self):
         """Get the current servo observation.
@@ -1565,8 +1811,8 @@ class HomeRobotZmqClient(AbstractRobotClient):
         Returns:
             Observations: the current servo observation
         """
-        with self._servo_lock:
-            return self._servo
+        # The decoder swaps in a complete object, so reading the reference is safe without a lock
+        return self._servo
 
     def blocking_spin_servo(self, verbose: bool = False):
         """Listen for servo messages coming from the robot, i.e. low res images for ML state. This is intended to be run in a separate thread.
@@ -1580,7 +1826,9 @@ class HomeRobotZmqClient(AbstractRobotClient):
         while not self._finish:
             t1 = timeit.default_timer()
             dt = t1 - t0
-            output = self.recv_servo_socket.recv_pyobj()
+            output = self._recv_pyobj(self.recv_servo_socket)
+            if output is None:
+                continue
             self.update_servo(output)
             sum_time += dt
             steps += 1
@@ -1625,7 +1873,9 @@ class HomeRobotZmqClient(AbstractRobotClient):
         t0 = timeit.default_timer()
 
         while not self._finish:
-            output = self.recv_state_socket.recv_pyobj()
+            output = self._recv_pyobj(self.recv_state_socket)
+            if output is None:
+                continue
             self._update_state(output)
 
             t1 = timeit.default_timer()
@@ -1676,12 +1926,14 @@ class HomeRobotZmqClient(AbstractRobotClient):
             return True
 
         self._thread = threading.Thread(target=self.blocking_spin)
+        self._decode_thread = threading.Thread(target=self.blocking_decode)
         self._state_thread = threading.Thread(target=self.blocking_spin_state)
         self._servo_thread = threading.Thread(target=self.blocking_spin_servo)
         if self._rerun:
             self._rerun_thread = threading.Thread(target=self.blocking_spin_rerun)  # type: ignore
         self._finish = False
         self._thread.start()
+        self._decode_thread.start()
         self._state_thread.start()
         self._servo_thread.start()
         if self._rerun:
@@ -1732,25 +1984,34 @@ class HomeRobotZmqClient(AbstractRobotClient):
 
     def __del__(self):
         """Destructor to make sure we stop the client when it is deleted"""
-        self.stop()
+        # The constructor may have exited early, e.g. if no robot address was found
+        if hasattr(self, "_stopped"):
+            self.stop()
 
     def stop(self):
-        """Stop the client and close all sockets"""
+        """Stop the client and close all sockets. Safe to call more than once."""
+        if self._stopped:
+            return
+        self._stopped = True
+        atexit.unregister(self.stop)
+
+        # Receive threads poll with a short timeout, so they notice this quickly
         self._finish = True
-        if self._thread is not None:
-            self._thread.join()
-        if self._state_thread is not None:
-            self._state_thread.join()
-        if self._servo_thread is not None:
-            self._servo_thread.join()
-        if self._rerun_thread is not None:
-            self._rerun_thread.join()
-
-        # Close the sockets and context
-        self.recv_socket.close()
-        self.recv_state_socket.close()
-        self.recv_servo_socket.close()
-        self.send_socket.close()
+        for thread in (
+            self._thread,
+            self._decode_thread,
+            self._state_thread,
+            self._servo_thread,
+            self._rerun_thread,
+        ):
+            if thread is not None and thread is not threading.current_thread():
+                thread.join()
+
+        # Close the sockets and context without waiting on unsent messages
+        self.recv_socket.close(linger=0)
+        self.recv_state_socket.close(linger=0)
+        self.recv_servo_socket.close(linger=0)
+        self.send_socket.close(linger=0)
         self.context.term()
 
 
@@ -9,7 +9,7 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
-import time
+import threading
 
 import click
 
@@ -31,26 +31,33 @@ def main(
     parameter_file: str = "config/default_planner.yaml",
     joint: str = "",
 ):
+    # Check the joint name up front; an unknown name raises ValueError here instead of on every
+    # state message
+    joint_idx = HelloStretchIdx.get_idx(joint.lower()) if len(joint) > 0 else None
+
     # Create robot
     robot = HomeRobotZmqClient(
         robot_ip=robot_ip,
         use_remote_computer=(not local),
         enable_rerun_server=False,
     )
+
+    def print_joint_state(state: dict):
+        joint_state = state.get("joint_positions")
+        if joint_state is None:
+            return
+        if joint_idx is not None:
+            print(f"{joint}: {joint_state[joint_idx]}")
+        else:
+            print(
+                f"Arm: {joint_state[HelloStretchIdx.ARM]}, Lift: {joint_state[HelloStretchIdx.LIFT]}, Gripper: {joint_state[HelloStretchIdx.GRIPPER]}"
+            )
+
+    # Print once per state message as it arrives instead of polling
+    robot.register_state_callback(print_joint_state)
     robot.start()
     try:
-        while True:
-            joint_state = robot.get_joint_positions()
-            if joint_state is None:
-                continue
-            if len(joint) > 0:
-                print(f"{joint}: {joint_state[HelloStretchIdx.get_idx(joint.lower())]}")
-            else:
-                print(
-                    f"Arm: {joint_state[HelloStretchIdx.ARM]}, Lift: {joint_state[HelloStretchIdx.LIFT]}, Gripper: {joint_state[HelloStretchIdx.GRIPPER]}"
-                )
-            time.sleep(0.01)
-
+        threading.Event().wait()
     except KeyboardInterrupt:
         pass
     robot.stop()
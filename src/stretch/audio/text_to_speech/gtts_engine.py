@@ -9,15 +9,30 @@
 
 # Standard imports
 import logging
+import queue
+import threading
+from collections import OrderedDict
 from io import BytesIO
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 # Third-party imports
+import gtts.tts
+import requests
 import simpleaudio
 import sounddevice  # suppress ALSA warnings # noqa: F401
 from gtts import gTTS
 from overrides import override
 from pydub import AudioSegment
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # Decodes MP3 in-process instead of through an ffmpeg subprocess
+    import miniaudio
+
+    miniaudio_found = True
+except ImportError:
+    miniaudio_found = False
 
 # Local imports
 from ..base import AbstractTextToSpeech
@@ -27,6 +42,32 @@ logging.basicConfig(level=logging.INFO)
 DEFAULT_LOGGER = logging.getLogger(__name__)
 
 
+class _PersistentSession(requests.Session):
+    """
+    A session that stays open when used as a context manager. gTTS opens a new
+    session for every request, which costs a TLS handshake per utterance.
+    """
+
+    def __exit__(self, *args: Any) -> None:
+        # Keep the pooled connections for the next request
+        pass
+
+
+class _PooledRequests:
+    """
+    Stands in for the requests module inside gTTS, handing out one shared session.
+    """
+
+    def __init__(self, session: requests.Session):
+        self._session = session
+
+    def Session(self) -> requests.Session:
+        return self._session
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(requests, name)
+
+
 class GTTSTextToSpeech(AbstractTextToSpeech):
     """
     Text-to-speech engine using gTTS.
@@ -35,8 +76,27 @@ class GTTSTextToSpeech(AbstractTextToSpeech):
     # Set a common framerate that's widely useful
     target_frame_rate: int = 44100
 
-    @override  # inherit the docstring from the parent class
-    def __init__(self, logger: logging.Logger = DEFAULT_LOGGER):
+    # Number of decoded utterances to keep, so repeated phrases skip the network and MP3 decode
+    pcm_cache_size: int = 64
+
+    # gTTS requests go through one pooled session shared by every instance. Sessions are not
+    # guaranteed to be thread-safe, so requests are serialized.
+    _session: Optional[requests.Session] = None
+    _synth_lock = threading.Lock()
+
+    @override
+    def __init__(self, logger: logging.Logger = DEFAULT_LOGGER, warmup: bool = True):
+        """
+        Initialize the text-to-speech engine.
+
+        Parameters
+        ----------
+        logger : logging.Logger
+            The logger to use for logging messages.
+        warmup : bool
+            Whether to play a short silent buffer now, so the audio device is already
+            open when the first utterance is spoken.
+        """
         super().__init__(logger)
         self._can_say_async = True
 
@@ -56,7 +116,61 @@ class GTTSTextToSpeech(AbstractTextToSpeech):
         self.voice_id = "com"
         self._playback: Optional[simpleaudio.PlayObject] = None
 
-    def __synthesize_text(self, text: str) -> gTTS:
+        # Decoded audio keyed by (text, voice_id, is_slow), least recently used first
+        self._pcm_cache: OrderedDict[
+            Tuple[str, str, bool], Tuple[bytes, int, int, int]
+        ] = OrderedDict()
+        self._pcm_cache_lock = threading.Lock()
+        # Utterances currently being synthesized, so a caller can wait instead of fetching again
+        self._pcm_in_progress: Dict[Tuple[str, str, bool], threading.Event] = {}
+
+        # Background synthesis for prefetch(); the thread is started on first use
+        self._pending: queue.Queue[Tuple[str, str, bool]] = queue.Queue()
+        self._prefetch_thread: Optional[threading.Thread] = None
+
+        self.__install_session()
+        if warmup:
+            self.__warmup_playback()
+
+    def __install_session(self) -> None:
+        """
+        Route gTTS requests through a single persistent session, so consecutive
+        utterances reuse the same HTTPS connection.
+        """
+        with GTTSTextToSpeech._synth_lock:
+            if GTTSTextToSpeech._session is not None:
+                return
+            if not hasattr(gtts.tts, "requests"):
+                self._logger.warning("Unsupported gTTS version; not pooling connections")
+                return
+            session = _PersistentSession()
+            adapter = HTTPAdapter(
+                pool_connections=1,
+                pool_maxsize=4,
+                max_retries=Retry(total=2, backoff_factor=0.2),
+            )
+            session.mount("https://", adapter)
+            gtts.tts.requests = _PooledRequests(session)
+            GTTSTextToSpeech._session = session
+
+    def __warmup_playback(self) -> None:
+        """
+        Play 10 ms of silence at the playback format, so opening and configuring the
+        audio device happens at startup instead of delaying the first utterance.
+        """
+        num_frames = self.target_frame_rate // 100
+        try:
+            warmup = simpleaudio.play_buffer(
+                b"\x00" * (num_frames * 2), 1, 2, self.target_frame_rate
+            )
+            warmup.wait_done()
+        except Exception as e:
+            # e.g. no audio device, as on headless machines
+            self._logger.debug(f"Could not warm up audio playback: {e}")
+
+    def __synthesize_text(
+        self, text: str, voice_id: Optional[str] = None, is_slow: Optional[bool] = None
+    ) -> gTTS:
         """
         Synthesize the given text.
 
@@ -64,39 +178,153 @@ class GTTSTextToSpeech(AbstractTextToSpeech):
         ----------
         text : str
             The text to speak.
+        voice_id : str, optional
+            The voice to use, by default the current voice.
+        is_slow : bool, optional
+            Whether to speak slowly, by default the current speed.
 
         Returns
         -------
         gTTS
             The synthesized text.
         """
-        return gTTS(text=text, lang="en", tld=self.voice_id, slow=self.is_slow)
+        if voice_id is None:
+            voice_id = self.voice_id
+        if is_slow is None:
+            is_slow = self.is_slow
+        return gTTS(text=text, lang="en", tld=voice_id, slow=is_slow)
 
-    def __play_text(self, tts: gTTS) -> None:
+    def __decode_text(self, tts: gTTS) -> Tuple[bytes, int, int, int]:
         """
-        Play the synthesized text.
+        Fetch and decode the synthesized text.
 
         Parameters
         ----------
         tts : gTTS
             The synthesized text.
+
+        Returns
+        -------
+        Tuple[bytes, int, int, int]
+            The raw PCM data, number of channels, sample width, and frame rate.
         """
         fp = BytesIO()
-        tts.write_to_fp(fp)
+        with self._synth_lock:
+            tts.write_to_fp(fp)
+        if miniaudio_found:
+            # gTTS produces mono audio; resample to the target rate while decoding
+            decoded = miniaudio.decode(
+                fp.getvalue(),
+                output_format=miniaudio.SampleFormat.SIGNED16,
+                nchannels=1,
+                sample_rate=self.target_frame_rate,
+            )
+            return (
+                decoded.samples.tobytes(),
+                decoded.nchannels,
+                decoded.sample_width,
+                decoded.sample_rate,
+            )
+
         fp.seek(0)
         audio = AudioSegment.from_file(fp, format="mp3")
 
         if audio.frame_rate != self.target_frame_rate:
             audio = audio.set_frame_rate(self.target_frame_rate)
 
+        return audio.raw_data, audio.channels, audio.sample_width, audio.frame_rate
+
+    def __get_pcm(self, key: Tuple[str, str, bool]) -> Tuple[bytes, int, int, int]:
+        """
+        Get the decoded audio for the given text, voice, and speed, synthesizing it
+        only if it is not already cached. If another thread is already synthesizing
+        it, wait for that result instead.
+
+        Parameters
+        ----------
+        key : Tuple[str, str, bool]
+            The text to speak, the voice ID, and whether to speak slowly.
+
+        Returns
+        -------
+        Tuple[bytes, int, int, int]
+            The raw PCM data, number of channels, sample width, and frame rate.
+        """
+        while True:
+            with self._pcm_cache_lock:
+                pcm = self._pcm_cache.get(key)
+                if pcm is not None:
+                    self._pcm_cache.move_to_end(key)
+                    return pcm
+                in_progress = self._pcm_in_progress.get(key)
+                if in_progress is None:
+                    done = threading.Event()
+                    self._pcm_in_progress[key] = done
+                    break
+            # Wait for the other synthesis, then check the cache again. If it failed,
+            # this thread takes over.
+            in_progress.wait()
+
+        try:
+            text, voice_id, is_slow = key
+            pcm = self.__decode_text(self.__synthesize_text(text, voice_id, is_slow))
+            with self._pcm_cache_lock:
+                self._pcm_cache[key] = pcm
+                if len(self._pcm_cache) > self.pcm_cache_size:
+                    self._pcm_cache.popitem(last=False)
+        finally:
+            with self._pcm_cache_lock:
+                del self._pcm_in_progress[key]
+            done.set()
+        return pcm
+
+    def __run_prefetch(self) -> None:
+        """
+        Synthesize queued utterances in the background so they are decoded by the
+        time they are spoken.
+        """
+        while True:
+            key = self._pending.get()
+            try:
+                self.__get_pcm(key)
+            except Exception as e:
+                self._logger.warning(f"Failed to prefetch {key[0]}: {e}")
+
+    def prefetch(self, texts: List[str]) -> None:
+        """
+        Start synthesizing the given texts in the background with the current voice
+        and speed, so that a later say or say_async of the same text starts playing
+        without waiting on the network or the MP3 decode.
+
+        Parameters
+        ----------
+        texts : List[str]
+            The texts that will be spoken.
+        """
+        if self._prefetch_thread is None:
+            self._prefetch_thread = threading.Thread(target=self.__run_prefetch, daemon=True)
+            self._prefetch_thread.start()
+        for text in texts:
+            self._pending.put((text, self.voice_id, self.is_slow))
+
+    def __play_text(self, text: str) -> None:
+        """
+        Play the given text.
+
+        Parameters
+        ----------
+        text : str
+            The text to speak.
+        """
+        # simpleaudio's output buffer latency is fixed when its C extension is built and has no
+        # runtime setting, so playback buffering is left at the library default
         self._playback = simpleaudio.play_buffer(
-            audio.raw_data, audio.channels, audio.sample_width, audio.frame_rate
+            *self.__get_pcm((text, self.voice_id, self.is_slow))
         )
 
     @override  # inherit the docstring from the parent class
     def say_async(self, text: str) -> None:
-        tts = self.__synthesize_text(text)
-        self.__play_text(tts)
+        self.__play_text(text)
 
     @override  # inherit the docstring from the parent class
     def is_speaking(self) -> bool:
@@ -109,8 +337,7 @@ class GTTSTextToSpeech(AbstractTextToSpeech):
 
     @override  # inherit the docstring from the parent class
     def say(self, text: str) -> None:
-        tts = self.__synthesize_text(text)
-        self.__play_text(tts)
+        self.__play_text(text)
         self._playback.wait_done()
         self._playback = None
 
@@ -125,4 +352,5 @@ class GTTSTextToSpeech(AbstractTextToSpeech):
         if not self.is_file_type_supported(filepath):
             return
         tts = self.__synthesize_text(text)
-        tts.save(filepath)
+        with self._synth_lock:
+            tts.save(filepath)
@@ -7,6 +7,7 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
+import pickle
 import threading
 import time
 import timeit
@@ -180,7 +181,7 @@ class BaseZmqServer(CommsNode, ABC):
             if steps == 0:
                 logger.info(f"[SEND LARGE IMAGE STATE] message keys: {data.keys()}")
 
-            self.send_socket.send_pyobj(data)
+            self.send_socket.send_pyobj(data, protocol=pickle.HIGHEST_PROTOCOL)
 
             # Finish with some speed info
             t1 = timeit.default_timer()
@@ -255,7 +256,7 @@ class BaseZmqServer(CommsNode, ABC):
             if steps == 0:
                 logger.info(f"[SEND MINIMAL STATE] message keys: {message.keys()}")
 
-            self.send_state_socket.send_pyobj(message)
+            self.send_state_socket.send_pyobj(message, protocol=pickle.HIGHEST_PROTOCOL)
 
             # Finish with some speed info
             t1 = timeit.default_timer()
@@ -285,7 +286,7 @@ class BaseZmqServer(CommsNode, ABC):
             if steps == 0:
                 logger.info(f"[SEND SERVO STATE] message keys: {message.keys()}")
 
-            self.send_servo_socket.send_pyobj(message)
+            self.send_servo_socket.send_pyobj(message, protocol=pickle.HIGHEST_PROTOCOL)
 
             # Finish with some speed info
             t1 = timeit.default_timer()
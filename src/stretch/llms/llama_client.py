@@ -7,8 +7,10 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
+import threading
 import timeit
-from typing import Optional, Union
+from contextlib import closing
+from typing import Dict, Iterator, List, Optional, Union
 
 import torch
 import transformers
@@ -19,6 +21,16 @@ from stretch.llms.base import AbstractLLMClient, AbstractPromptBuilder
 default_model_id = "meta-llama/Meta-Llama-3.1-8B"
 
 
+class _StopOnEvent(transformers.StoppingCriteria):
+    """Stops generation once the event is set, e.g. when a streamed response is abandoned."""
+
+    def __init__(self):
+        self.event = threading.Event()
+
+    def __call__(self, input_ids, scores, **kwargs) -> bool:
+        return self.event.is_set()
+
+
 class LlamaClient(AbstractLLMClient):
     def chat_template(self, prompt):
         return f"\nUser: {prompt}\nAssistant:"
@@ -28,7 +40,22 @@ class LlamaClient(AbstractLLMClient):
         prompt: Optional[Union[str, AbstractPromptBuilder]],
         model_id: str = None,
         max_tokens: int = 512,
+        compile_model: bool = False,
+        quantization: Optional[str] = None,
     ):
+        """Create a Llama client.
+
+        Args:
+            prompt: system prompt or prompt builder
+            model_id: huggingface model to load; defaults to Llama 3.1 8B
+            max_tokens: maximum number of tokens generated per response
+            compile_model: compile the model forward pass with torch.compile. This uses CUDA
+                graphs and a static KV cache, so the first calls are slow while it warms up.
+            quantization: load the weights quantized with bitsandbytes, either "nf4" (4-bit,
+                roughly 5.5 GB of VRAM for the 8B model instead of 16 GB) or "int8" (roughly
+                9 GB). Decoding is memory-bandwidth bound, so smaller weights are also faster.
+                Requires the bitsandbytes package. None loads the weights in bfloat16.
+        """
         super().__init__(prompt)
         self.max_tokens = max_tokens
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
@@ -40,37 +67,138 @@ class LlamaClient(AbstractLLMClient):
         self.tokenizer.chat_template = self.chat_template
         self.tokenizer.system_prompt = self.system_prompt
         self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Decoder-only models continue from the last token, so batched prompts are padded on
+        # the left
+        self.tokenizer.padding_side = "left"
+
+        # The chat framing and system prompt never change, so tokenize them once. Each message is
+        # tokenized when it is added, so the growing history is never re-tokenized as a whole.
+        self._bos_ids = self.tokenizer.encode("", add_special_tokens=True)
+        self._system_prompt_ids = self._encode(self.system_prompt)
+        self._user_prefix_ids = self._encode("\nUser:")
+        self._assistant_prefix_ids = self._encode("\nAssistant:")
+        self._history_ids: List[List[int]] = []
 
-        # Set up huggingface inference pipeline
-        self.pipe = transformers.pipeline(
-            "text-generation",
-            # TODO: remove old code
-            model=model_id,
-            model_kwargs={"torch_dtype": torch.bfloat16},
-            # model=model,
-            tokenizer=self.tokenizer,
+        # Call the model directly rather than through a text-generation pipeline, which rebuilds
+        # its generation config and post-processes the full text on every call
+        self.model = transformers.AutoModelForCausalLM.from_pretrained(
+            model_id,
+            torch_dtype=torch.bfloat16,
             device_map="auto",
+            quantization_config=self._get_quantization_config(quantization),
         )
+        self.model.eval()
+        self.generation_config = transformers.GenerationConfig(
+            max_new_tokens=self.max_tokens,
+            do_sample=False,
+            use_cache=True,
+            pad_token_id=self.tokenizer.eos_token_id,
+            eos_token_id=self.tokenizer.eos_token_id,
+        )
+        if compile_model:
+            # A static cache keeps tensor shapes fixed so the compiled graph can be replayed
+            self.generation_config.cache_implementation = "static"
+            self.model.forward = torch.compile(
+                self.model.forward, mode="reduce-overhead", fullgraph=False
+            )
 
-    def __call__(self, command: str, verbose: bool = False):
-        # return self.pipe(command, max_new_tokens=self.max_tokens)[0]["generated_text"].strip()
-        if self.is_first_message():
-            new_message = self.system_prompt + self.chat_template(command)
+    @staticmethod
+    def _get_quantization_config(quantization: Optional[str]):
+        if quantization is None:
+            return None
+        elif quantization == "nf4":
+            return transformers.BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_use_double_quant=True,
+            )
+        elif quantization == "int8":
+            return transformers.BitsAndBytesConfig(load_in_8bit=True)
         else:
-            new_message = self.chat_template(command)
+            raise ValueError(f"Unknown quantization: {quantization}")
 
-        self.add_history(new_message)
-        # Prepare the messages including the conversation history
-        messages = self.get_history_as_str()
+    def reset(self) -> None:
+        super().reset()
+        self._history_ids = []
 
-        t0 = timeit.default_timer()
-        output = self.pipe(messages, max_new_tokens=self.max_tokens)
-        t1 = timeit.default_timer()
+    def _encode(self, text: str) -> List[int]:
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def _encode_user_message(self, command: str) -> List[int]:
+        """Token ids for chat_template(command), preceded by the system prompt on the first
+        message. The space after "User:" is encoded with the command, since the tokenizer joins
+        leading spaces onto the following word."""
+        ids = self._system_prompt_ids if self.is_first_message() else []
+        return (
+            ids + self._user_prefix_ids + self._encode(" " + command) + self._assistant_prefix_ids
+        )
+
+    def _encode_history(self) -> List[int]:
+        """Token ids for get_history_as_str(), tokenizing only messages not seen before"""
+        history = self.get_history()
+        if len(self._history_ids) > len(history):
+            self._history_ids = []
+        for item in history[len(self._history_ids) :]:
+            if isinstance(item, str):
+                self._history_ids.append(self._encode(item))
+            else:
+                self._history_ids.append(self._encode(f"\n{item['role']}: {item['content']}"))
+        return self._bos_ids + [token for ids in self._history_ids for token in ids]
+
+    def _get_inputs(self, prompt: Union[str, List[int]]) -> Dict[str, torch.Tensor]:
+        if isinstance(prompt, str):
+            return self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        input_ids = torch.tensor([prompt], device=self.model.device)
+        return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
 
-        # Get response text
-        assistant_response = output[0]["generated_text"].strip()
-        assistant_response = assistant_response[len(messages) :].strip()
+    def generate(self, prompt: Union[str, List[int]]) -> str:
+        """Generate a completion for the given text or token ids, returning only the newly
+        generated part."""
+        inputs = self._get_inputs(prompt)
+        with torch.inference_mode():
+            output_ids = self.model.generate(**inputs, generation_config=self.generation_config)
+        new_ids = output_ids[0, inputs["input_ids"].shape[1] :]
+        return self.tokenizer.decode(new_ids, skip_special_tokens=True)
 
+    def generate_batch(self, texts: List[str]) -> List[str]:
+        """Generate completions for several texts with a single padded call to the model. Decoding
+        is memory-bandwidth bound, so a batch costs little more per step than a single prompt.
+        Decoding is greedy, so outputs do not depend on which other prompts share the batch, up
+        to numerical differences from padding."""
+        inputs = self.tokenizer(texts, return_tensors="pt", padding=True).to(self.model.device)
+        with torch.inference_mode():
+            output_ids = self.model.generate(**inputs, generation_config=self.generation_config)
+        new_ids = output_ids[:, inputs["input_ids"].shape[1] :]
+        return self.tokenizer.batch_decode(new_ids, skip_special_tokens=True)
+
+    def generate_stream(self, prompt: Union[str, List[int]]) -> Iterator[str]:
+        """Generate a completion for the given text or token ids, yielding decoded text as it is
+        produced. Generation stops early if the iterator is closed."""
+        inputs = self._get_inputs(prompt)
+        streamer = transformers.TextIteratorStreamer(
+            self.tokenizer, skip_prompt=True, skip_special_tokens=True
+        )
+        stop = _StopOnEvent()
+
+        def _generate():
+            with torch.inference_mode():
+                self.model.generate(
+                    **inputs,
+                    generation_config=self.generation_config,
+                    streamer=streamer,
+                    stopping_criteria=transformers.StoppingCriteriaList([stop]),
+                )
+
+        thread = threading.Thread(target=_generate, daemon=True)
+        thread.start()
+        try:
+            yield from streamer
+        finally:
+            stop.event.set()
+            thread.join()
+
+    def _trim_response(self, assistant_response: str) -> str:
         # Hack: search for "User" in the response and remove everything after it
         user_idx = assistant_response.find("User")
         if user_idx != -1:
@@ -80,6 +208,36 @@ class LlamaClient(AbstractLLMClient):
         )
         if assistant_idx != -1:
             assistant_response = assistant_response[:assistant_idx]
+        return assistant_response
+
+    def __call__(self, command: str, verbose: bool = False, stream: bool = False):
+        """Respond to a command.
+
+        Args:
+            command: the user's message
+            verbose: print the response and time taken
+            stream: return an iterator over the response text as it is generated instead of the
+                full response, so consumers such as text to speech can start early. The response
+                is added to the history once the iterator is exhausted.
+        """
+        if self.is_first_message():
+            new_message = self.system_prompt + self.chat_template(command)
+        else:
+            new_message = self.chat_template(command)
+
+        # Prepare the messages including the conversation history
+        self._encode_history()
+        self._history_ids.append(self._encode_user_message(command))
+        self.add_history(new_message)
+        input_ids = self._encode_history()
+
+        if stream:
+            return self._stream_response(input_ids, verbose)
+
+        t0 = timeit.default_timer()
+        assistant_response = self.generate(input_ids).strip()
+        t1 = timeit.default_timer()
+        assistant_response = self._trim_response(assistant_response)
 
         # Add the assistant's response to the conversation history
         self.add_history({"role": "assistant", "content": assistant_response})
@@ -88,6 +246,35 @@ class LlamaClient(AbstractLLMClient):
             print(f"Time taken: {t1 - t0:.2f}s")
         return assistant_response
 
+    def _stream_response(self, input_ids: List[int], verbose: bool = False) -> Iterator[str]:
+        t0 = timeit.default_timer()
+        generated = ""
+        num_yielded = 0
+        with closing(self.generate_stream(input_ids)) as stream:
+            for text in stream:
+                generated += text
+                # Hold back enough text that a partial "User" or "Assistant" is never yielded
+                assistant_response = self._trim_response(generated.lstrip())
+                trimmed = len(assistant_response) < len(generated.lstrip())
+                holdback = 0 if trimmed else len("Assistant") - 1
+                safe_len = len(assistant_response) - holdback
+                if safe_len > num_yielded:
+                    yield assistant_response[num_yielded:safe_len]
+                    num_yielded = safe_len
+                if trimmed:
+                    break
+        t1 = timeit.default_timer()
+
+        assistant_response = self._trim_response(generated.strip())
+        if len(assistant_response) > num_yielded:
+            yield assistant_response[num_yielded:]
+
+        # Add the assistant's response to the conversation history
+        self.add_history({"role": "assistant", "content": assistant_response})
+        if verbose:
+            print(f"Assistant response: {assistant_response}")
+            print(f"Time taken: {t1 - t0:.2f}s")
+
 
 if __name__ == "__main__":
     from stretch.llms.prompts.simple_prompt import SimpleStretchPromptBuilder
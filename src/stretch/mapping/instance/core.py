@@ -15,7 +15,7 @@
 from dataclasses import dataclass, field
 from functools import cached_property
 from pathlib import Path
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -137,6 +137,14 @@ class Instance:
     score: float = None
     """Confidence score of bbox detection"""
     score_aggregation_method: str = "max"
+    _embedding_cache: Dict[Tuple[str, bool, bool], Tensor] = field(
+        default_factory=dict, init=False, repr=False, compare=False
+    )
+    """Aggregated embeddings, cleared whenever a view is added"""
+    _point_sum: Optional[Tensor] = field(default=None, init=False, repr=False, compare=False)
+    """Running sum of point_cloud, updated incrementally as views are added"""
+    _point_sum_count: int = field(default=0, init=False, repr=False, compare=False)
+    _centroid: Optional[np.ndarray] = field(default=None, init=False, repr=False, compare=False)
 
     @property
     def id(self) -> int:
@@ -154,7 +162,11 @@ class Instance:
     def get_image_embedding(
         self, aggregation_method="max", normalize: bool = True, use_visual_feat: bool = False
     ):
-        """Get the combined image embedding across all views"""
+        """Get the combined image embedding across all views. The result is cached until a new view is added, so it should not be modified in place."""
+        key = (aggregation_method, normalize, use_visual_feat)
+        emb = self._embedding_cache.get(key)
+        if emb is not None:
+            return emb
         if use_visual_feat:
             view_embeddings = [view.visual_feat for view in self.instance_views]
         else:
@@ -176,6 +188,7 @@ class Instance:
         if normalize:
             emb = emb / emb.norm(dim=-1, keepdim=True)
 
+        self._embedding_cache[key] = emb
         return emb
 
     def get_best_view(self, metric: str = "area") -> InstanceView:
@@ -215,6 +228,29 @@ class Instance:
         center_xyz[2] = xyz[2]
         return center_xyz
 
+    def get_centroid(self) -> np.ndarray:
+        """Get the mean of the instance point cloud. Uses a running sum kept up to date as views are added, and only moves the result off the device once per change.
+
+        Returns:
+            np.ndarray: [3,] mean xyz of the instance points
+        """
+        if self._centroid is None:
+            if self._point_sum is None or self._point_sum_count != self.point_cloud.shape[0]:
+                self._point_sum = self.point_cloud.sum(dim=0)
+                self._point_sum_count = self.point_cloud.shape[0]
+            self._centroid = (self._point_sum / self._point_sum_count).cpu().numpy()
+        return self._centroid
+
+    def _accumulate_points(self, points: Optional[Tensor]) -> None:
+        """Add a view's points to the running point sum used by get_centroid."""
+        self._centroid = None
+        if points is None or self._point_sum is None:
+            # Recomputed from the full point cloud on the next call to get_centroid
+            self._point_sum = None
+            return
+        self._point_sum = self._point_sum + points.sum(dim=0)
+        self._point_sum_count += points.shape[0]
+
     def show_best_view(self, metric: str = "area", title: Optional[str] = None) -> None:
         """Show the best view of the instance"""
         best_view = self.get_best_view(metric=metric)
@@ -226,6 +262,7 @@ class Instance:
         cv2.destroyAllWindows()
 
     def add_instance_view(self, instance_view: InstanceView):
+        self._embedding_cache.clear()
         if len(self.instance_views) == 0:
             # instantiate from instance
             self.category_id = instance_view.category_id
@@ -235,7 +272,10 @@ class Instance:
             self.point_cloud_rgb = instance_view.point_cloud_rgb
             self.point_cloud_features = instance_view.point_cloud_features
             self.score = instance_view.score
+            self._point_sum = None
+            self._centroid = None
         else:
+            self._accumulate_points(instance_view.point_cloud)
             # Right now we concatenate point clouds
             # To keep the number of points manageable, we could make the pointcloud a VoxelizedPointcloud class
             self.point_cloud = torch.cat([self.point_cloud, instance_view.point_cloud], dim=0)
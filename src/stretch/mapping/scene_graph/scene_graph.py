@@ -7,7 +7,7 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
-from typing import List, Optional, Tuple, Union
+from typing import List, Optional, Set, Tuple, Union
 
 import numpy as np
 import torch
@@ -81,6 +81,19 @@ class SceneGraph:
             and (rel[2] == relation or relation is None)
         ]
 
+    def get_objects_on(self, surface: Union[int, str]) -> Set[int]:
+        """Get the ids of all instances that are on a surface, e.g. "floor". Use this instead of calling get_matching_relations once per instance.
+
+        Args:
+            surface: The instance id of the surface, or "floor"
+
+        Returns:
+            Set of global ids of instances on the surface
+        """
+        if isinstance(surface, Instance):
+            surface = surface.global_id
+        return {rel[0] for rel in self.relationships if rel[1] == surface and rel[2] == "on"}
+
     def get_ins_center_pos(self, idx: int):
         """Get the center of an instance based on point cloud"""
         return torch.mean(self.instances[idx].point_cloud, axis=0)
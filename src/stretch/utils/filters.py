@@ -129,14 +129,21 @@ class MaskTemporalFilter(TemporalFilter):
         if num_mask_pts == 0:
             mask_center = None
         else:
-            mask_pts = np.argwhere(mask)
-            mask_center = mask_pts.mean(axis=0)
+            # Use the row and column projections of the mask rather than listing every point
+            row_counts = np.count_nonzero(mask, axis=1)
+            col_counts = np.count_nonzero(mask, axis=0)
+            mask_center = np.array(
+                [
+                    np.dot(row_counts, np.arange(mask.shape[0])) / num_mask_pts,
+                    np.dot(col_counts, np.arange(mask.shape[1])) / num_mask_pts,
+                ]
+            )
 
         return mask_center
 
     @staticmethod
     def count_mask_pixels(mask: np.ndarray) -> int:
-        return sum(mask.flatten())
+        return np.count_nonzero(mask)
 
     def push_mask_to_observation_history(
         self,
@@ -7,7 +7,7 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
-from typing import Optional, Sequence, Tuple
+from typing import List, Optional, Sequence, Tuple
 
 import cv2
 import numpy as np
@@ -31,8 +31,17 @@ def detect_aruco_markers(
 
 
 class GripperArucoDetector:
-    def __init__(self):
+    def __init__(self, roi_padding: int = 64, roi_scale: float = 0.5):
+        """Create a detector for the gripper AR markers.
+
+        Args:
+            roi_padding: Padding in pixels around the last detected markers when tracking them with track_center.
+            roi_scale: Scale factor applied to the region of interest before detection when tracking.
+        """
         self.aruco_detector = get_gripper_aruco_detector()
+        self.roi_padding = roi_padding
+        self.roi_scale = roi_scale
+        self._last_marker_bounds: Optional[Tuple[float, float, float, float]] = None
 
     def detect_aruco_markers(self, image: np.ndarray) -> Tuple[Sequence[np.ndarray], np.ndarray]:
         """Detect AR markers in an image.
@@ -90,3 +99,69 @@ class GripperArucoDetector:
             return None
         center = (centers[0] + centers[1]) / 2
         return center[0]
+
+    def reset_tracking(self) -> None:
+        """Forget where the markers were last seen, so that the next call to track_center searches the full image."""
+        self._last_marker_bounds = None
+
+    def _detect_in_roi(self, gray: np.ndarray) -> Optional[List[np.ndarray]]:
+        """Detect the two finger markers in a region around where they were last seen.
+
+        Args:
+            gray: Full grayscale image.
+
+        Returns:
+            corners: Corners of the two markers in full image coordinates, or None if they were not both found.
+        """
+        height, width = gray.shape[:2]
+        x0, y0, x1, y1 = self._last_marker_bounds
+        x0 = max(int(x0) - self.roi_padding, 0)
+        y0 = max(int(y0) - self.roi_padding, 0)
+        x1 = min(int(np.ceil(x1)) + self.roi_padding, width)
+        y1 = min(int(np.ceil(y1)) + self.roi_padding, height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+
+        roi = gray[y0:y1, x0:x1]
+        if self.roi_scale != 1.0:
+            roi = cv2.resize(
+                roi, None, fx=self.roi_scale, fy=self.roi_scale, interpolation=cv2.INTER_AREA
+            )
+        else:
+            roi = np.ascontiguousarray(roi)
+
+        corners, _ = self.detect_aruco_markers(roi)
+        if len(corners) < 2:
+            return None
+        offset = np.array([x0, y0], dtype=np.float32)
+        return [(c + 0.5) / self.roi_scale - 0.5 + offset for c in corners[:2]]
+
+    def track_center(self, image: np.ndarray) -> Optional[np.ndarray]:
+        """Get the center between the two finger AR markers, like detect_center, but searching a downscaled region around the last detection first. Falls back to the full image if the markers are not found there.
+
+        Args:
+            image: RGB or grayscale image to detect the markers in.
+
+        Returns:
+            center: 2D array, The center point between the two finger AR markers.
+        """
+        gray = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) if image.ndim == 3 else image
+
+        corners = None
+        if self._last_marker_bounds is not None:
+            corners = self._detect_in_roi(gray)
+        if corners is None:
+            corners, _ = self.detect_aruco_markers(gray)
+            if len(corners) < 2:
+                self._last_marker_bounds = None
+                return None
+            corners = list(corners[:2])
+
+        points = np.concatenate([c.reshape(-1, 2) for c in corners], axis=0)
+        x0, y0 = points.min(axis=0)
+        x1, y1 = points.max(axis=0)
+        self._last_marker_bounds = (x0, y0, x1, y1)
+
+        centers = [np.mean(c, axis=1) for c in corners]
+        center = (centers[0] + centers[1]) / 2
+        return center[0]
@@ -13,7 +13,7 @@
 # LICENSE file in the root directory of this source tree.
 import copy
 import functools
-from typing import List
+from typing import List, Optional, Tuple
 
 import cv2
 import numpy as np
@@ -163,16 +163,40 @@ class Camera(object):
     def get_pose(self):
         return self.pose_matrix.copy()
 
-    def depth_to_xyz(self, depth, data_type: type = np.float16):
-        """get depth from numpy using simple pinhole self model"""
-        indices = np.indices((self.height, self.width), dtype=np.float32).transpose(1, 2, 0)
-        z = depth
-        # pixel indices start at top-left corner. for these equations, it starts at bottom-left
-        x = (indices[:, :, 1] - self.px) * (z / self.fx)
-        y = (indices[:, :, 0] - self.py) * (z / self.fy)
-        # Should now be height x width x 3, after this:
-        xyz = np.stack([x, y, z], axis=-1).astype(data_type)
-        return xyz
+    def _get_ray_grid(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Get the per-pixel x and y scale factors (u - px) / fx and (v - py) / fy. These only depend on the intrinsics, so they are computed once and reused until the intrinsics change."""
+        key = (self.height, self.width, self.px, self.py, self.fx, self.fy)
+        if getattr(self, "_ray_grid_key", None) != key:
+            # pixel indices start at top-left corner. for these equations, it starts at bottom-left
+            u = (np.arange(self.width, dtype=np.float32) - self.px) / self.fx
+            v = (np.arange(self.height, dtype=np.float32) - self.py) / self.fy
+            self._ray_grid = (
+                np.broadcast_to(u[None, :], (self.height, self.width)),
+                np.broadcast_to(v[:, None], (self.height, self.width)),
+            )
+            self._ray_grid_key = key
+        return self._ray_grid
+
+    def depth_to_xyz(
+        self, depth, data_type: type = np.float16, out: Optional[np.ndarray] = None
+    ) -> np.ndarray:
+        """get depth from numpy using simple pinhole self model
+
+        Args:
+            depth: height x width depth image
+            data_type: dtype of the returned xyz image
+            out: optional height x width x 3 array of data_type to write the result into
+
+        Returns:
+            np.ndarray: height x width x 3 xyz image
+        """
+        x_scale, y_scale = self._get_ray_grid()
+        if out is None:
+            out = np.empty((self.height, self.width, 3), dtype=data_type)
+        np.multiply(x_scale, depth, out=out[..., 0], casting="unsafe")
+        np.multiply(y_scale, depth, out=out[..., 1], casting="unsafe")
+        np.copyto(out[..., 2], depth, casting="unsafe")
+        return out
 
     def fix_depth(self, depth):
         if isinstance(depth, np.ndarray):
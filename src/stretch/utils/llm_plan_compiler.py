@@ -8,6 +8,9 @@
 # license information maybe found below, if so.
 
 import ast
+from collections import OrderedDict
+from functools import partial
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 from stretch.agent.operations import (
     GoToNavOperation,
@@ -29,13 +32,79 @@ class LLMTreeNode:
     """Represents a node in the tree of function calls.
     Each node has a function call and two branches for success and failure"""
 
-    def __init__(self, function_call, success=None, failure=None):
+    def __init__(self, function_call: ast.Call, success=None, failure=None):
         self.function_call = function_call
         self.success = success
         self.failure = failure
 
+    @property
+    def function_name(self) -> str:
+        """Name of the function called at this node"""
+        func = self.function_call.func
+        if not isinstance(func, ast.Name):
+            raise ValueError(f"Unsupported function call: {ast.unparse(self.function_call)}")
+        return func.id
+
+
+class _ChainStatements:
+    """Marker used by build_tree to link the statements of a function body once built"""
+
+    def __init__(self, num_statements: int):
+        self.operations = [None] * num_statements
+
+
+# Syntax an LLM plan may use: a function body of if/else branches and calls with literal arguments
+_allowed_node_types = (
+    ast.Module,
+    ast.FunctionDef,
+    ast.arguments,
+    ast.arg,
+    ast.If,
+    ast.Expr,
+    ast.Call,
+    ast.keyword,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.UnaryOp,
+    ast.USub,
+    ast.UAdd,
+    ast.List,
+    ast.Tuple,
+)
+
+
+def validate_plan(tree: ast.AST, allowed_functions: Iterable[str]) -> None:
+    """Reject a parsed plan that uses syntax or functions outside the plan grammar, so a bad plan
+    fails before any of it is compiled. Uses ast.walk, which is iterative, so deeply nested plans
+    are fine."""
+    allowed_functions = set(allowed_functions)
+    call_targets = set()
+    # ast.walk yields every node after its parent, so calls are seen before their function names
+    for node in ast.walk(tree):
+        if not isinstance(node, _allowed_node_types):
+            raise ValueError(f"Unsupported syntax in LLM plan: {type(node).__name__}")
+        if isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in allowed_functions:
+                raise ValueError(f"Unknown function in LLM plan: {ast.unparse(node.func)}")
+            call_targets.add(id(node.func))
+            # The compiler reads arguments with ast.literal_eval, so only literals are allowed
+            for arg in node.args + [keyword.value for keyword in node.keywords]:
+                try:
+                    ast.literal_eval(arg)
+                except (ValueError, TypeError):
+                    raise ValueError(
+                        f"Non-literal argument in LLM plan: {ast.unparse(arg)}"
+                    ) from None
+        elif isinstance(node, ast.Name) and id(node) not in call_targets:
+            raise ValueError(f"Unexpected name in LLM plan: {node.id}")
+
 
 class LLMPlanCompiler(ast.NodeVisitor):
+    # Parsed call trees by plan source, shared across compilers so re-running a plan skips parsing
+    _tree_cache: OrderedDict[str, LLMTreeNode] = OrderedDict()
+    tree_cache_size: int = 32
+
     def __init__(self, agent: RobotAgent, llm_plan: str):
         self.agent = agent
         self.robot = agent.robot
@@ -44,6 +113,27 @@ class LLMPlanCompiler(ast.NodeVisitor):
         self.root = None
         self._operation_naming_counter = 0
 
+        # "Not implemented" speak operations by (name, message, parent), shared between leaf nodes
+        self._stub_cache: Dict[Tuple[str, str, Optional[str]], str] = {}
+        self._reuse_stubs = False
+        self._stub_parent: Optional[str] = None
+
+        # Work stack used by build_tree, and the callback for the node being visited
+        self._build_stack: List[Tuple[object, Callable[[LLMTreeNode], None]]] = []
+        self._attach: Optional[Callable[[LLMTreeNode], None]] = None
+
+        # Functions the LLM plan is allowed to call
+        self._dispatch = {
+            "go_to": self.go_to,
+            "pick": self.pick,
+            "place": self.place,
+            "say": self.say,
+            "wave": self.wave,
+            "open_cabinet": self.open_cabinet,
+            "close_cabinet": self.close_cabinet,
+            "get_detections": self.get_detections,
+        }
+
     def go_to(self, location: str):
         """Adds a GoToNavOperation to the task"""
         _, current_object = self.agent.get_instance_from_text(location)
@@ -221,119 +311,154 @@ class LLMPlanCompiler(ast.NodeVisitor):
         self._operation_naming_counter += 1
         return "wave" + f"_{str(self._operation_naming_counter - 1)}"
 
-    def open_cabinet(self):
-        """Adds a SpeakOperation (not implemented) to the task"""
+    def _add_stub(self, name: str, message: str) -> str:
+        """Adds a SpeakOperation for an unimplemented function to the task. Leaf nodes with the
+        same name, message and parent share one operation, since nothing follows them and their
+        on_failure edge points back to the same parent.
+
+        Args:
+            name: name of the unimplemented function
+            message: message to speak
+
+        Returns:
+            str: name of the operation
+        """
+        key = (name, message, self._stub_parent)
+        if self._reuse_stubs and key in self._stub_cache:
+            return self._stub_cache[key]
+
         speak_not_implemented = SpeakOperation(
-            name="open_cabinet" + f"_{str(self._operation_naming_counter)}",
+            name=name + f"_{str(self._operation_naming_counter)}",
             agent=self.agent,
             robot=self.robot,
         )
         self._operation_naming_counter += 1
-        speak_not_implemented.configure(message="Open cabinet operation not implemented")
+        speak_not_implemented.configure(message=message)
         self.task.add_operation(speak_not_implemented, True)
-        return "open_cabinet" + f"_{str(self._operation_naming_counter - 1)}"
+        if self._reuse_stubs:
+            self._stub_cache[key] = speak_not_implemented.name
+        return speak_not_implemented.name
+
+    def open_cabinet(self):
+        """Adds a SpeakOperation (not implemented) to the task"""
+        return self._add_stub("open_cabinet", "Open cabinet operation not implemented")
 
     def close_cabinet(self):
         """Adds a SpeakOperation (not implemented) to the task"""
-        speak_not_implemented = SpeakOperation(
-            name="close_cabinet" + f"_{str(self._operation_naming_counter)}",
-            agent=self.agent,
-            robot=self.robot,
-        )
-        self._operation_naming_counter += 1
-        speak_not_implemented.configure(message="Close cabinet operation not implemented")
-        self.task.add_operation(speak_not_implemented, True)
-        return "close_cabinet" + f"_{str(self._operation_naming_counter - 1)}"
+        return self._add_stub("close_cabinet", "Close cabinet operation not implemented")
 
     def get_detections(self):
         """Adds a SpeakOperation (not implemented) to the task"""
-        speak_not_implemented = SpeakOperation(
-            name="get_detections" + f"_{str(self._operation_naming_counter)}",
-            agent=self.agent,
-            robot=self.robot,
-        )
-        self._operation_naming_counter += 1
-        speak_not_implemented.configure(message="Get detections operation not implemented")
-        self.task.add_operation(speak_not_implemented, True)
-        return "get_detections" + f"_{str(self._operation_naming_counter - 1)}"
+        return self._add_stub("get_detections", "Get detections operation not implemented")
 
     def build_tree(self, node):
-        """Recursively build a tree of function calls"""
-        if isinstance(node, ast.If):
-            # Extract function call in the test condition
-            test = node.test
-            if isinstance(test, ast.Call):
-                function_call = ast.unparse(test)
-            else:
-                raise ValueError("Unexpected test condition")
-
-            # Create the root node with the function call
-            if self.root is None:
-                self.root = LLMTreeNode(function_call=function_call)
-                new_node = self.root
-            else:
-                new_node = LLMTreeNode(function_call=function_call)
-
-            # Recursively build success and failure branches
-            if len(node.body) > 0:
-                new_node.success = self.build_tree(node.body[0])
-            if len(node.orelse) > 0:
-                new_node.failure = self.build_tree(node.orelse[0])
-
-            return new_node
-
-        elif isinstance(node, ast.Expr):
-            # Extract function call
-            expr = node.value
-            if isinstance(expr, ast.Call):
-                function_call = ast.unparse(expr)
+        """Build a tree of function calls. Uses an explicit stack instead of recursion so deeply
+        nested plans do not hit the interpreter's recursion limit; nodes are still created in
+        the same (depth-first, success before failure) order.
+
+        Each AST node is dispatched to its visit_<NodeType> method. Visitors return the tree node
+        they created, if any, and push their children onto the stack."""
+        result = [None]
+
+        def set_result(tree_node):
+            result[0] = tree_node
+
+        # Each entry is (ast node, callback receiving the built tree node). A FunctionDef also
+        # pushes a marker that chains its statements once they have all been built.
+        self._build_stack = [(node, set_result)]
+        while self._build_stack:
+            node, self._attach = self._build_stack.pop()
+            if isinstance(node, _ChainStatements):
+                self._chain_statements(node)
+                continue
+
+            tree_node = self.visit(node)
+            if tree_node is not None:
                 if self.root is None:
-                    self.root = LLMTreeNode(function_call=function_call)
-                    return self.root
-                else:
-                    return LLMTreeNode(function_call=function_call)
-
-        elif isinstance(node, ast.Module):
-            # Start processing the body of the module
-            if len(node.body) > 0:
-                return self.build_tree(node.body[0])
-
-        elif isinstance(node, ast.FunctionDef):
-            if len(node.body) > 0:
-                previous_operation = None
-                first_operation = None
-                for expr in node.body:
-                    operation = self.build_tree(expr)
+                    self.root = tree_node
+                self._attach(tree_node)
 
-                    if first_operation is None:
-                        first_operation = operation
+        return result[0]
 
-                    if previous_operation is None:
-                        previous_operation = operation
-                        continue
-
-                    if previous_operation.function_call.startswith(
-                        "say"
-                    ) or previous_operation.function_call.startswith("wave"):
-                        previous_operation.success = operation
-
-                    previous_operation = operation
-
-                return first_operation
+    def visit_If(self, node: ast.If) -> LLMTreeNode:
+        # Extract function call in the test condition
+        test = node.test
+        if isinstance(test, ast.Call):
+            function_call = test
         else:
-            print("Unknown node type")
-
-        raise ValueError("Unexpected AST node")
+            raise ValueError("Unexpected test condition")
+        new_node = LLMTreeNode(function_call=function_call)
+
+        # Build success and failure branches; failure is pushed first so the success branch is
+        # built first
+        if len(node.orelse) > 0:
+            self._build_stack.append((node.orelse[0], partial(setattr, new_node, "failure")))
+        if len(node.body) > 0:
+            self._build_stack.append((node.body[0], partial(setattr, new_node, "success")))
+        return new_node
+
+    def visit_Expr(self, node: ast.Expr) -> LLMTreeNode:
+        # Extract function call
+        if not isinstance(node.value, ast.Call):
+            return self.generic_visit(node)
+        return LLMTreeNode(function_call=node.value)
+
+    def visit_Module(self, node: ast.Module) -> None:
+        # Start processing the body of the module
+        if len(node.body) == 0:
+            return self.generic_visit(node)
+        self._build_stack.append((node.body[0], self._attach))
+
+    def visit_FunctionDef(self, node: ast.FunctionDef) -> None:
+        if len(node.body) == 0:
+            return self.generic_visit(node)
+        chain = _ChainStatements(len(node.body))
+        self._build_stack.append((chain, self._attach))
+        for i in reversed(range(len(node.body))):
+            self._build_stack.append((node.body[i], partial(chain.operations.__setitem__, i)))
+
+    def _chain_statements(self, chain: _ChainStatements) -> None:
+        """Link the statements of a function body once they have all been built"""
+        operations = chain.operations
+        for previous_operation, operation in zip(operations, operations[1:]):
+            if previous_operation.function_name in ("say", "wave"):
+                previous_operation.success = operation
+        self._attach(operations[0])
+
+    def generic_visit(self, node: ast.AST):
+        """Any AST node without a visit_<NodeType> method is not part of the plan grammar"""
+        raise ValueError(f"Unexpected AST node: {type(node).__name__}")
 
     def convert_to_task(
         self, root: LLMTreeNode, parent_operation_name: str = None, success: bool = True
     ):
-        """Recursively convert the tree into a task by adding operations and connecting them"""
-        if root is None:
-            return
-
-        # Create the operation
-        operation_ret = eval("self." + root.function_call)
+        """Convert the tree into a task by adding operations and connecting them. Uses an explicit
+        stack instead of recursion; nodes are visited in the same order as a depth-first walk
+        with success branches before failure branches."""
+        stack = [(root, parent_operation_name, success)]
+        while stack:
+            root, parent_operation_name, success = stack.pop()
+            if root is None:
+                continue
+            root_operation_name = self._add_tree_node(root, parent_operation_name, success)
+            # Failure is pushed first so the success branch is processed first
+            stack.append((root.failure, root_operation_name, False))
+            stack.append((root.success, root_operation_name, True))
+
+    def _add_tree_node(self, root: LLMTreeNode, parent_operation_name: str, success: bool) -> str:
+        """Add the operation for one tree node and connect it to its parent. Returns the name of
+        the operation its children attach to."""
+        # Create the operation. The tree was validated when it was built, so it only calls known
+        # functions with literal arguments.
+        call = root.function_call
+        function_name = root.function_name
+        args = [ast.literal_eval(arg) for arg in call.args]
+        kwargs = {kw.arg: ast.literal_eval(kw.value) for kw in call.keywords}
+        # A shared stub can only have one on_success and one on_failure, so only leaves under the
+        # same parent may reuse one
+        self._reuse_stubs = root.success is None and root.failure is None
+        self._stub_parent = parent_operation_name
+        operation_ret = self._dispatch[function_name](*args, **kwargs)
 
         intermediate_operation_name = None
 
@@ -376,16 +501,42 @@ class LLMPlanCompiler(ast.NodeVisitor):
                     self.task.connect_on_failure(parent_operation_name, root_operation_name)
                     self.task.connect_on_failure(root_operation_name, parent_operation_name)
 
-        # Recursively process the success and failure branches
-        self.convert_to_task(root.success, root_operation_name, True)
-        self.convert_to_task(root.failure, root_operation_name, False)
+        return root_operation_name
+
+    def get_tree(self, llm_plan: str) -> LLMTreeNode:
+        """Get the call tree for a plan, parsing it only if it is not already cached"""
+        root = self._tree_cache.get(llm_plan)
+        if root is None:
+            self.root = None
+            tree = ast.parse(llm_plan)
+            validate_plan(tree, self._dispatch.keys())
+            self.build_tree(tree)
+            root = self.root
+            self._tree_cache[llm_plan] = root
+            if len(self._tree_cache) > self.tree_cache_size:
+                self._tree_cache.popitem(last=False)
+        else:
+            self._tree_cache.move_to_end(llm_plan)
+        return root
+
+    def warmup(self, plans: List[str]) -> None:
+        """Parse known plans ahead of time, e.g. a library of recipes at startup, so compiling
+        them later skips straight to building the task"""
+        root = self.root
+        for plan in plans:
+            self.get_tree(plan)
+        self.root = root
 
     def compile(self):
         """Compile the LLM plan into a task"""
         self._operation_naming_counter = 0
+        self._stub_cache = {}
         self.task = Task()
-        tree = ast.parse(self.llm_plan)
-        self.build_tree(tree)
+
+        # Only the call tree is cached. The task is rebuilt every time because operations hold
+        # state while they run (e.g. success flags and target objects) and are bound to this
+        # agent, so a cached task could not be reused safely.
+        self.root = self.get_tree(self.llm_plan)
         self.convert_to_task(self.root)
 
         return self.task
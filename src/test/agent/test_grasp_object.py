@@ -0,0 +1,259 @@
+# Copyright (c) Hello Robot, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in the root directory
+# of this source tree.
+#
+# Some code may be adapted from other open-source works with their respective licenses. Original
+# license information maybe found below, if so.
+
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from stretch.agent.operations.grasp_object import GraspObjectOperation
+
+
+class FakeSemanticSensor:
+    def __init__(self, names: dict, vocabulary_id: int = 0):
+        self.names = names
+        self.current_vocabulary_id = vocabulary_id
+
+    def get_class_name_for_id(self, oid: int):
+        return self.names.get(int(oid))
+
+
+class FakeRobot:
+    parameters = None
+
+    def get_robot_model(self):
+        return None
+
+
+class FakeAgent:
+    def __init__(self, semantic_sensor: FakeSemanticSensor):
+        self.robot = FakeRobot()
+        self.parameters = None
+        self.space = None
+        self.semantic_sensor = semantic_sensor
+        self.current_object = None
+
+
+def _make_grasp(names: dict, target_object: str = "cup") -> GraspObjectOperation:
+    grasp = GraspObjectOperation("grasp", agent=FakeAgent(FakeSemanticSensor(names)))
+    grasp.target_object = target_object
+    grasp.match_method = "class"
+    return grasp
+
+
+def _class_mask_loop(semantic: np.ndarray, semantic_sensor, target_class: str) -> np.ndarray:
+    """Reference implementation: the per-id loop get_class_mask used before the lookup table"""
+    mask = np.zeros_like(semantic).astype(bool)
+    for iid in np.unique(semantic):
+        name = semantic_sensor.get_class_name_for_id(iid)
+        if name is not None and target_class in name:
+            mask = np.bitwise_or(mask, semantic == iid)
+    return mask
+
+
+def _random_semantic(seed: int = 0) -> np.ndarray:
+    # Includes -1 for background and an id (5) that has no class name
+    return np.random.default_rng(seed).integers(-1, 6, size=(48, 64))
+
+
+@pytest.mark.parametrize(
+    "names",
+    [
+        {0: "table", 1: "chair", 2: "sofa"},
+        {0: "table", 1: "cup", 2: "sofa"},
+        {0: "table", 1: "cup", 2: "red cup", 3: "sofa", 4: "cup lid"},
+        {0: "cup", 1: "table", 2: "sofa", 3: "chair", 4: "red cup"},
+    ],
+    ids=["no_match", "one_match", "several_matches", "several_matches_last_id"],
+)
+def test_class_mask_matches_loop(names):
+    grasp = _make_grasp(names)
+    for seed in range(3):
+        semantic = _random_semantic(seed)
+        servo = SimpleNamespace(semantic=semantic)
+        expected = _class_mask_loop(semantic, grasp.agent.semantic_sensor, "cup")
+        mask = grasp.get_class_mask(servo)
+        assert mask.dtype == bool
+        assert mask.shape == semantic.shape
+        assert np.array_equal(mask, expected)
+
+
+def test_class_lut_is_cached():
+    grasp = _make_grasp({0: "table", 1: "cup", 2: "red cup"})
+    servo = SimpleNamespace(semantic=_random_semantic())
+    grasp.get_class_mask(servo)
+    class_lut = grasp._class_lut
+    grasp.get_class_mask(servo)
+    assert grasp._class_lut is class_lut
+
+
+def test_class_lut_grows_with_larger_ids():
+    grasp = _make_grasp({0: "table", 1: "cup", 2: "red cup", 9: "cup"})
+    grasp.get_class_mask(SimpleNamespace(semantic=_random_semantic()))
+    semantic = np.random.default_rng(1).integers(-1, 10, size=(48, 64))
+    mask = grasp.get_class_mask(SimpleNamespace(semantic=semantic))
+    assert np.array_equal(mask, _class_mask_loop(semantic, grasp.agent.semantic_sensor, "cup"))
+
+
+def test_class_lut_rebuilt_on_vocabulary_change():
+    grasp = _make_grasp({0: "table", 1: "cup", 2: "red cup"})
+    semantic = _random_semantic()
+    servo = SimpleNamespace(semantic=semantic)
+    grasp.get_class_mask(servo)
+
+    # Same sensor, new vocabulary
+    semantic_sensor = grasp.agent.semantic_sensor
+    semantic_sensor.names = {0: "cup", 1: "table", 2: "sofa", 3: "cup"}
+    semantic_sensor.current_vocabulary_id = 1
+    mask = grasp.get_class_mask(servo)
+    assert np.array_equal(mask, _class_mask_loop(semantic, semantic_sensor, "cup"))
+
+
+def test_class_lut_rebuilt_on_sensor_change():
+    grasp = _make_grasp({0: "table", 1: "cup", 2: "red cup"})
+    semantic = _random_semantic()
+    servo = SimpleNamespace(semantic=semantic)
+    old_sensor = grasp.agent.semantic_sensor
+    grasp.get_class_mask(servo)
+
+    # A different sensor with the same vocabulary id
+    new_sensor = FakeSemanticSensor({0: "cup", 3: "cup", 4: "red cup"})
+    grasp.agent.semantic_sensor = new_sensor
+    mask = grasp.get_class_mask(servo)
+    assert np.array_equal(mask, _class_mask_loop(semantic, new_sensor, "cup"))
+    assert old_sensor is not new_sensor
+
+
+def test_class_lut_rebuilt_on_target_change():
+    grasp = _make_grasp({0: "table", 1: "cup", 2: "red cup"})
+    semantic = _random_semantic()
+    servo = SimpleNamespace(semantic=semantic)
+    grasp.get_class_mask(servo)
+    grasp.target_object = "table"
+    mask = grasp.get_class_mask(servo)
+    assert np.array_equal(mask, _class_mask_loop(semantic, grasp.agent.semantic_sensor, "table"))
+
+
+def _target_mask_loop(grasp, servo, center, prev_mask=None):
+    """Reference implementation: the per-instance loop get_target_mask used before bincount"""
+    class_mask = grasp.get_class_mask(servo)
+    instance_mask = servo.instance
+    target_mask = None
+    target_mask_pts = float("-inf")
+    maximum_overlap_mask = None
+    maximum_overlap_pts = float("-inf")
+    center_x, center_y = center
+    for iid in np.unique(instance_mask):
+        current_instance_mask = instance_mask == iid
+        if class_mask[center_y, center_x] > 0 and current_instance_mask[center_y, center_x] > 0:
+            return current_instance_mask
+        if prev_mask is not None and grasp.use_prev_mask:
+            mask = np.bitwise_and(current_instance_mask, prev_mask)
+            mask = np.bitwise_and(mask, class_mask)
+            num_pts = np.count_nonzero(mask)
+            if num_pts > maximum_overlap_pts:
+                maximum_overlap_pts = num_pts
+                maximum_overlap_mask = mask
+        mask = np.bitwise_and(current_instance_mask, class_mask)
+        num_pts = np.count_nonzero(mask)
+        if num_pts > target_mask_pts:
+            target_mask = mask
+            target_mask_pts = num_pts
+    if maximum_overlap_pts > grasp.min_points_to_approach:
+        return maximum_overlap_mask
+    if target_mask is not None:
+        return target_mask
+    return prev_mask
+
+
+def _make_servo(cup_instances=(0, 1), background_cup_pixels: int = 0) -> SimpleNamespace:
+    """Frame with background (-1) and three instances of increasing size; the instances listed in
+    cup_instances are cups, the rest are tables"""
+    instance = -np.ones((60, 80), dtype=np.int64)
+    semantic = np.zeros((60, 80), dtype=np.int64)
+    blocks = {0: (slice(5, 15), slice(5, 20)), 1: (slice(20, 40), slice(5, 25))}
+    blocks[2] = (slice(20, 50), slice(40, 70))
+    for iid, block in blocks.items():
+        instance[block] = iid
+        semantic[block] = 1 if iid in cup_instances else 2
+    if background_cup_pixels > 0:
+        semantic[55:, :background_cup_pixels] = 1
+    return SimpleNamespace(instance=instance, semantic=semantic, ee_xyz=np.zeros((60, 80, 3)))
+
+
+def _make_target_grasp(min_points_to_approach: int = 100) -> GraspObjectOperation:
+    grasp = _make_grasp({0: "background", 1: "cup", 2: "table"})
+    grasp.min_points_to_approach = min_points_to_approach
+    return grasp
+
+
+def test_target_mask_centered_on_object():
+    grasp = _make_target_grasp()
+    servo = _make_servo()
+    # Center is on instance 0, which is a cup but not the largest one
+    center = (10, 10)
+    mask = grasp.get_target_mask(servo, center)
+    assert np.array_equal(mask, servo.instance == 0)
+    assert np.array_equal(mask, _target_mask_loop(grasp, servo, center))
+
+
+def test_target_mask_largest_instance():
+    grasp = _make_target_grasp()
+    servo = _make_servo()
+    # Center is on a table, so the cup with the most points wins
+    center = (50, 30)
+    mask = grasp.get_target_mask(servo, center)
+    assert np.array_equal(mask, servo.instance == 1)
+    assert np.array_equal(mask, _target_mask_loop(grasp, servo, center))
+
+
+@pytest.mark.parametrize("min_points_to_approach", [100, 1000])
+def test_target_mask_prev_mask_overlap(min_points_to_approach):
+    grasp = _make_target_grasp(min_points_to_approach)
+    grasp.use_prev_mask = True
+    servo = _make_servo()
+    center = (50, 30)
+    # The previous mask covers the smaller cup (150 points). It only wins when that is more than
+    # min_points_to_approach; otherwise the largest cup is used.
+    prev_mask = servo.instance == 0
+    mask = grasp.get_target_mask(servo, center, prev_mask=prev_mask)
+    assert np.array_equal(mask, _target_mask_loop(grasp, servo, center, prev_mask=prev_mask))
+    expected_instance = 0 if min_points_to_approach < 150 else 1
+    assert np.array_equal(mask, servo.instance == expected_instance)
+
+
+def test_target_mask_empty_class_mask():
+    grasp = _make_target_grasp()
+    servo = _make_servo(cup_instances=())
+    center = (10, 10)
+    mask = grasp.get_target_mask(servo, center)
+    assert mask is not None
+    assert not mask.any()
+    assert np.array_equal(mask, _target_mask_loop(grasp, servo, center))
+
+
+def test_target_mask_background_bin():
+    grasp = _make_target_grasp()
+    # More cup pixels in the background (-1) than in any cup instance
+    servo = _make_servo(cup_instances=(0,), background_cup_pixels=80)
+    center = (50, 30)
+    mask = grasp.get_target_mask(servo, center)
+    expected = _target_mask_loop(grasp, servo, center)
+    assert np.array_equal(mask, expected)
+    assert np.array_equal(mask, (servo.instance == -1) & (servo.semantic == 1))
+
+
+def test_target_mask_is_not_a_scratch_buffer():
+    grasp = _make_target_grasp()
+    servo = _make_servo()
+    center = (50, 30)
+    first = grasp.get_target_mask(servo, center)
+    first_copy = first.copy()
+    grasp.get_target_mask(_make_servo(cup_instances=(2,)), center)
+    assert np.array_equal(first, first_copy)
@@ -0,0 +1,226 @@
+# Copyright (c) Hello Robot, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in the root directory
+# of this source tree.
+#
+# Some code may be adapted from other open-source works with their respective licenses. Original
+# license information maybe found below, if so.
+
+import pickle
+import threading
+
+import numpy as np
+import pytest
+
+from stretch.agent.zmq_client import HomeRobotZmqClient
+from stretch.core.interfaces import Observations
+
+
+def _make_client() -> HomeRobotZmqClient:
+    """Client with just the state used by get_observation, without any sockets or threads"""
+    client = HomeRobotZmqClient.__new__(HomeRobotZmqClient)
+    client._obs_lock = threading.Condition()
+    client._obs = None
+    client._observation = None
+    client._seq_id = 0
+    client.is_up_to_date = lambda: True
+    return client
+
+
+def _make_observation() -> Observations:
+    return Observations(
+        gps=np.zeros(2),
+        compass=np.zeros(1),
+        rgb=np.zeros((4, 4, 3), dtype=np.uint8),
+        depth=np.zeros((4, 4)),
+        task_observations={"object_name": "cup"},
+    )
+
+
+def test_get_observation_none():
+    assert _make_client().get_observation() is None
+
+
+def test_get_observation_returns_copies():
+    client = _make_client()
+    client._observation = _make_observation()
+
+    first = client.get_observation()
+    second = client.get_observation()
+    assert first is not second
+    assert first is not client._observation
+    # Image arrays are shared, not copied
+    assert first.rgb is client._observation.rgb
+
+    # What the semantic sensor does to an observation must not leak into other callers
+    first.semantic = np.ones((4, 4))
+    first.task_observations["object_goal"] = 1
+    assert second.semantic is None
+    assert "object_goal" not in second.task_observations
+    assert client.get_observation().task_observations == {"object_name": "cup"}
+
+
+def _make_batch_client() -> HomeRobotZmqClient:
+    """Client with just the state used by send_action. Messages are recorded instead of sent, and
+    acked right away so reliable sends do not wait."""
+    client = HomeRobotZmqClient.__new__(HomeRobotZmqClient)
+    client._act_lock = threading.Lock()
+    client._state_lock = threading.Condition()
+    client._iter = 0
+    client._last_step = -1
+    client._batch_local = threading.local()
+    client.sent = []
+
+    def _send_serialized(data: bytes):
+        message = pickle.loads(data)
+        client._last_step = message.pop("step")
+        client.sent.append(message)
+
+    client._send_serialized = _send_serialized
+    return client
+
+
+@pytest.mark.parametrize(
+    "action, expected",
+    [
+        ({}, False),
+        ({"manip_blocking": False}, False),
+        ({"joint": [0.0] * 6}, True),
+        ({"joint": [0.0] * 6, "manip_blocking": False}, True),
+        ({"joint": [0.0] * 6, "manip_blocking": True}, False),
+        ({"gripper": 0.5, "gripper_blocking": False}, True),
+        ({"gripper": 0.5, "gripper_blocking": True}, False),
+        ({"head_to": [0.0, -0.5], "manip_blocking": False}, True),
+        ({"xyt": [0.0, 0.0, 0.0]}, False),
+        ({"posture": "navigation"}, False),
+        ({"joint": [0.0] * 6, "xyt": [0.0, 0.0, 0.0]}, False),
+    ],
+)
+def test_can_batch(action, expected):
+    assert _make_batch_client()._can_batch(action) == expected
+
+
+def test_send_action_outside_batch():
+    client = _make_batch_client()
+    client.send_action({"gripper": 0.5, "gripper_blocking": False})
+    assert client.sent == [{"gripper": 0.5, "gripper_blocking": False}]
+
+
+def test_batch_merges_commands():
+    client = _make_batch_client()
+    with client.batch():
+        client.send_action({"joint": [0.0] * 6, "manip_blocking": False})
+        client.send_action({"head_to": [0.0, -0.5], "manip_blocking": False})
+        client.send_action({"gripper": 0.2, "gripper_blocking": False})
+        # Later commands overwrite earlier ones for the same field
+        client.send_action({"gripper": 0.5, "gripper_blocking": False})
+        assert client.sent == []
+    assert client.sent == [
+        {
+            "joint": [0.0] * 6,
+            "head_to": [0.0, -0.5],
+            "gripper": 0.5,
+            "manip_blocking": False,
+            "gripper_blocking": False,
+        }
+    ]
+    assert client._get_batched_action() is None
+
+
+def test_batch_splits_head_and_gripper():
+    client = _make_batch_client()
+    with client.batch():
+        client.send_action({"head_to": [0.0, -0.5], "manip_blocking": False})
+        client.send_action({"gripper": 0.5, "gripper_blocking": False})
+    # Without a joint command the robot cannot execute head and gripper as one message
+    assert client.sent == [
+        {"head_to": [0.0, -0.5], "manip_blocking": False},
+        {"gripper": 0.5, "gripper_blocking": False},
+    ]
+
+
+def test_batch_sends_other_actions_immediately():
+    client = _make_batch_client()
+    with client.batch():
+        client.send_action({"gripper": 0.5, "gripper_blocking": False})
+        client.send_action({"xyt": [1.0, 0.0, 0.0]})
+        client.send_action({"joint": [0.0] * 6, "manip_blocking": True})
+        assert client.sent == [
+            {"xyt": [1.0, 0.0, 0.0]},
+            {"joint": [0.0] * 6, "manip_blocking": True},
+        ]
+    assert client.sent[-1] == {"gripper": 0.5, "gripper_blocking": False}
+    assert len(client.sent) == 3
+
+
+def test_empty_batch_sends_nothing():
+    client = _make_batch_client()
+    with client.batch():
+        pass
+    assert client.sent == []
+    assert client._get_batched_action() is None
+
+
+def test_batch_flushes_on_exception():
+    client = _make_batch_client()
+    with pytest.raises(RuntimeError):
+        with client.batch():
+            client.send_action({"joint": [0.0] * 6, "manip_blocking": False})
+            client.send_action({"gripper": 0.5, "gripper_blocking": False})
+            raise RuntimeError("interrupted")
+    # Nothing queued before the exception is dropped, and batching is switched off again
+    assert client.sent == [
+        {"joint": [0.0] * 6, "gripper": 0.5, "manip_blocking": False, "gripper_blocking": False}
+    ]
+    assert client._get_batched_action() is None
+    client.send_action({"gripper": 0.1, "gripper_blocking": False})
+    assert client.sent[-1] == {"gripper": 0.1, "gripper_blocking": False}
+
+
+def test_nested_batch_flushes_with_outer_batch():
+    client = _make_batch_client()
+    with client.batch():
+        client.send_action({"joint": [0.0] * 6, "manip_blocking": False})
+        with client.batch():
+            client.send_action({"gripper": 0.5, "gripper_blocking": False})
+        # The inner block must not send the outer batch early
+        assert client.sent == []
+        client.send_action({"head_to": [0.0, -0.5], "manip_blocking": False})
+    assert client.sent == [
+        {
+            "joint": [0.0] * 6,
+            "head_to": [0.0, -0.5],
+            "gripper": 0.5,
+            "manip_blocking": False,
+            "gripper_blocking": False,
+        }
+    ]
+    assert client._get_batched_action() is None
+
+
+def test_batch_ignores_other_threads():
+    client = _make_batch_client()
+    with client.batch():
+        client.send_action({"joint": [0.0] * 6, "manip_blocking": False})
+        thread = threading.Thread(
+            target=client.send_action, args=({"gripper": 0.5, "gripper_blocking": False},)
+        )
+        thread.start()
+        thread.join()
+        # Sent right away instead of being held back by this thread's batch
+        assert client.sent == [{"gripper": 0.5, "gripper_blocking": False}]
+    assert client.sent[-1] == {"joint": [0.0] * 6, "manip_blocking": False}
+    assert len(client.sent) == 2
+
+
+def test_batch_does_not_merge_unreliable_sends():
+    client = _make_batch_client()
+    with client.batch():
+        action = client.send_action({"gripper": 0.5, "gripper_blocking": False}, reliable=False)
+        assert client.sent == [{"gripper": 0.5, "gripper_blocking": False}]
+        assert "step" in action
+        merged = client.send_action({"gripper": 0.2, "gripper_blocking": False})
+        # A merged command has not been sent yet, so it has no step
+        assert "step" not in merged
+    assert client.sent[-1] == {"gripper": 0.2, "gripper_blocking": False}
@@ -7,7 +7,10 @@
 # Some code may be adapted from other open-source works with their respective licenses. Original
 # license information maybe found below, if so.
 
+from typing import Optional
+
 import numpy as np
+import pytest
 
 from stretch.agent import RobotAgent
 from stretch.core import Parameters
@@ -32,16 +35,32 @@ similarity_threshold = 0.05
 debug = False
 
 
-def _eval_svm(filename: str, start_pos: np.ndarray, possible: bool = False) -> None:
-
-    print("==== SVM Evaluation ====")
-    print(f"Loading voxel map from {filename}...")
+def _create_parameters() -> Parameters:
     config = Config()
     config.merge_from_file(TEST_PLANNER_FILENAME)
     config.freeze()
-    parameters = Parameters(**config)
+    return Parameters(**config)
+
+
+@pytest.fixture(scope="module")
+def parameters() -> Parameters:
+    """Planner parameters, shared by the tests in this module. They are only read, so sharing
+    them is safe; each test still creates its own robot."""
+    return _create_parameters()
+
 
+def _eval_svm(
+    filename: str,
+    start_pos: np.ndarray,
+    possible: bool = False,
+    parameters: Optional[Parameters] = None,
+) -> None:
+
+    print("==== SVM Evaluation ====")
+    print(f"Loading voxel map from {filename}...")
     print("Create dummy robot and agent...")
+    if parameters is None:
+        parameters = _create_parameters()
     dummy_robot = DummyStretchClient()
     agent = RobotAgent(
         dummy_robot,
@@ -138,15 +157,19 @@ def _eval_svm(filename: str, start_pos: np.ndarray, possible: bool = False) -> N
         ), f"Failed to delete instance; {new_instance_id} == {instance_id}"
 
 
-def test_svm_small():
-    _eval_svm(SMALL_DATA_FILE, SMALL_DATA_START, possible=False)
-
-
-def test_svm_large():
-    _eval_svm(LARGE_DATA_FILE, LARGE_DATA_START, possible=True)
+@pytest.mark.parametrize(
+    "filename,start_pos,possible",
+    [
+        (SMALL_DATA_FILE, SMALL_DATA_START, False),
+        (LARGE_DATA_FILE, LARGE_DATA_START, True),
+    ],
+    ids=["small", "large"],
+)
+def test_svm(parameters, filename, start_pos, possible):
+    _eval_svm(filename, start_pos, possible=possible, parameters=parameters)
 
 
 if __name__ == "__main__":
     debug = True
-    # test_svm_small()
-    test_svm_large()
+    # _eval_svm(SMALL_DATA_FILE, SMALL_DATA_START, possible=False)
+    _eval_svm(LARGE_DATA_FILE, LARGE_DATA_START, possible=True)
@@ -0,0 +1,273 @@
+# Copyright (c) Hello Robot, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the license found in the LICENSE file in the root directory
+# of this source tree.
+#
+# Some code may be adapted from other open-source works with their respective licenses. Original
+# license information maybe found below, if so.
+
+import ast
+import re
+
+import pytest
+
+from stretch.llms.prompts.object_manip_nav_prompt import PROMPT_EXAMPLES
+from stretch.utils.llm_plan_compiler import LLMPlanCompiler, validate_plan
+
+
+class FakeRobot:
+    parameters = None
+
+    def get_robot_model(self):
+        return None
+
+
+class FakeAgent:
+    def __init__(self):
+        self.robot = FakeRobot()
+        self.parameters = None
+        self.space = None
+
+    def get_instance_from_text(self, text: str):
+        return None, None
+
+
+def _graph(task):
+    """(name, on_success, on_failure, on_cannot_start) for every operation, in insertion order"""
+
+    def _name(operation):
+        return None if operation is None else operation.name
+
+    return [
+        (op.name, _name(op.on_success), _name(op.on_failure), _name(op.on_cannot_start))
+        for op in task._all_operations
+    ]
+
+
+NESTED_PLAN = """
+def execute_task(go_to, pick, place, say, open_cabinet, close_cabinet, wave, get_detections):
+    if pick("cup"):
+        if go_to("table"):
+            if place("table"):
+                say("done")
+            else:
+                say("failed to place")
+        else:
+            say("cannot reach table")
+    else:
+        say("no cup")
+        wave()
+"""
+
+# Graph produced by the recursive, eval-based compiler for NESTED_PLAN
+NESTED_GRAPH = [
+    ("go_to_navigation_mode_0", "search_for_cup_on_floor_1", "go_to_navigation_mode_0", None),
+    ("search_for_cup_on_floor_1", "go_to_object_2", "search_for_cup_on_floor_1", None),
+    ("go_to_object_2", "pregrasp_cup_3", None, "search_for_cup_on_floor_1"),
+    ("pregrasp_cup_3", "pick_cup_4", "pregrasp_cup_3", None),
+    ("pick_cup_4", "go_to_table_5", "say_no cup_13", None),
+    ("go_to_table_5", "go_to_navigation_mode_6", "say_cannot reach table_12", None),
+    ("go_to_navigation_mode_6", "search_for_table_7", "go_to_table_5", None),
+    ("search_for_table_7", "go_to_receptacle_8", "search_for_table_7", None),
+    ("go_to_receptacle_8", "place_table_9", None, "search_for_table_7"),
+    ("place_table_9", "say_done_10", "say_failed to place_11", "go_to_receptacle_8"),
+    ("say_done_10", None, "place_table_9", None),
+    ("say_failed to place_11", None, "place_table_9", None),
+    ("say_cannot reach table_12", None, "go_to_table_5", None),
+    ("say_no cup_13", None, "pick_cup_4", None),
+]
+
+ELIF_PLAN = """
+def execute_task(go_to, pick, place, say, open_cabinet, close_cabinet, wave, get_detections):
+    say("starting")
+    if go_to("kitchen"):
+        say("in kitchen")
+    elif go_to("living room"):
+        if pick("apple"):
+            say("got apple")
+        else:
+            open_cabinet()
+    else:
+        wave()
+"""
+
+# Graph produced by the recursive, eval-based compiler for ELIF_PLAN
+ELIF_GRAPH = [
+    ("say_starting_0", "go_to_kitchen_1", None, None),
+    ("go_to_kitchen_1", "say_in kitchen_2", "go_to_living room_3", None),
+    ("say_in kitchen_2", None, "go_to_kitchen_1", None),
+    ("go_to_living room_3", "go_to_navigation_mode_4", "wave_11", None),
+    ("go_to_navigation_mode_4", "search_for_apple_on_floor_5", "go_to_living room_3", None),
+    ("search_for_apple_on_floor_5", "go_to_object_6", "search_for_apple_on_floor_5", None),
+    ("go_to_object_6", "pregrasp_apple_7", None, "search_for_apple_on_floor_5"),
+    ("pregrasp_apple_7", "pick_apple_8", "pregrasp_apple_7", None),
+    ("pick_apple_8", "say_got apple_9", "open_cabinet_10", None),
+    ("say_got apple_9", None, "pick_apple_8", None),
+    ("open_cabinet_10", None, "pick_apple_8", None),
+    ("wave_11", None, "go_to_living room_3", None),
+]
+
+
+@pytest.mark.parametrize(
+    "plan, expected_graph, expected_initial",
+    [
+        (NESTED_PLAN, NESTED_GRAPH, "go_to_navigation_mode_0"),
+        (ELIF_PLAN, ELIF_GRAPH, "say_starting_0"),
+    ],
+    ids=["nested", "elif"],
+)
+def test_compiled_graph_matches_baseline(plan, expected_graph, expected_initial):
+    compiler = LLMPlanCompiler(FakeAgent(), plan)
+    task = compiler.compile()
+    assert _graph(task) == expected_graph
+    assert task.initial_operation.name == expected_initial
+
+
+def test_recompile_from_cached_tree():
+    first = LLMPlanCompiler(FakeAgent(), NESTED_PLAN).compile()
+    # The second compiler reuses the cached call tree but must build a fresh task
+    second = LLMPlanCompiler(FakeAgent(), NESTED_PLAN).compile()
+    assert second is not first
+    assert _graph(second) == _graph(first) == NESTED_GRAPH
+    assert NESTED_PLAN in LLMPlanCompiler._tree_cache
+
+
+def test_warmup_does_not_change_graph():
+    compiler = LLMPlanCompiler(FakeAgent(), ELIF_PLAN)
+    compiler.warmup([NESTED_PLAN, ELIF_PLAN])
+    assert compiler.root is None
+    assert _graph(compiler.compile()) == ELIF_GRAPH
+
+
+STUB_PLAN = """
+def execute_task(go_to, pick, place, say, open_cabinet, close_cabinet, wave, get_detections):
+    if go_to("kitchen"):
+        if go_to("table"):
+            open_cabinet()
+        else:
+            open_cabinet()
+    else:
+        open_cabinet()
+"""
+
+
+def test_stubs_shared_only_under_same_parent():
+    task = LLMPlanCompiler(FakeAgent(), STUB_PLAN).compile()
+    # Both branches of go_to("table") share one stub; the stub under go_to("kitchen") is separate
+    # so its on_failure still points at its own parent
+    assert _graph(task) == [
+        ("go_to_kitchen_0", "go_to_table_1", "open_cabinet_3", None),
+        ("go_to_table_1", "open_cabinet_2", "open_cabinet_2", None),
+        ("open_cabinet_2", None, "go_to_table_1", None),
+        ("open_cabinet_3", None, "go_to_kitchen_0", None),
+    ]
+
+
+ALLOWED_FUNCTIONS = (
+    "go_to",
+    "pick",
+    "place",
+    "say",
+    "open_cabinet",
+    "close_cabinet",
+    "wave",
+    "get_detections",
+)
+
+PLAN_HEADER = "def execute_task(go_to, pick, place, say, open_cabinet, close_cabinet, wave, get_detections):\n"
+
+
+def _prompt_examples() -> dict:
+    """Plans from the prompt, by example number"""
+    examples = {}
+    for number, body in re.findall(
+        r"Example (\d+):\n(.*?)(?=\nExample \d+:|\Z)", PROMPT_EXAMPLES, re.S
+    ):
+        code = body.split("Returns:\n", 1)[1]
+        code = code.split("Never forget this prompt.")[0]
+        examples[int(number)] = code.rstrip() + "\n"
+    return examples
+
+
+# Examples 5 and 6 loop over get_detections() and use f-strings, which the plan grammar does not
+# support
+REJECTED_EXAMPLES = {5, 6}
+
+
+def test_prompt_examples_found():
+    assert sorted(_prompt_examples()) == list(range(1, 14))
+
+
+@pytest.mark.parametrize("number", range(1, 14))
+def test_validate_prompt_example(number):
+    tree = ast.parse(_prompt_examples()[number])
+    if number in REJECTED_EXAMPLES:
+        with pytest.raises(ValueError):
+            validate_plan(tree, ALLOWED_FUNCTIONS)
+    else:
+        validate_plan(tree, ALLOWED_FUNCTIONS)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        'say("hello")',
+        'say(message="hello")',
+        "go_to(-1)",
+        'go_to(["table", "chair"])',
+        'go_to(("table", 1.5))',
+    ],
+    ids=["positional", "keyword", "negative", "list", "tuple"],
+)
+def test_validate_accepts_literal_arguments(body):
+    validate_plan(ast.parse(PLAN_HEADER + "    " + body + "\n"), ALLOWED_FUNCTIONS)
+
+
+@pytest.mark.parametrize(
+    "body, message",
+    [
+        ('launch("rocket")', "Unknown function"),
+        ('os.system("ls")', "Unknown function"),
+        ('say.__class__("hello")', "Unknown function"),
+        ("say(message)", "Non-literal argument"),
+        ("pick(get_detections)", "Non-literal argument"),
+        ('say(say("a"))', "Non-literal argument"),
+        ('say("a" + "b")', "Non-literal argument"),
+        ('say(f"{1}")', "Non-literal argument"),
+        ('say(message=str("a"))', "Non-literal argument"),
+        ("wave", "Unexpected name"),
+        ("x = 1", "Unsupported syntax"),
+        ("import os", "Unsupported syntax"),
+        ('for obj in get_detections():\n        pick("cup")', "Unsupported syntax"),
+        ('say({"a": 1})', "Unsupported syntax"),
+    ],
+    ids=[
+        "unknown_call",
+        "attribute_call",
+        "dunder_attribute_call",
+        "bare_name_argument",
+        "function_as_argument",
+        "call_argument",
+        "binop_argument",
+        "fstring_argument",
+        "call_keyword_argument",
+        "bare_name_statement",
+        "assignment",
+        "import",
+        "for_loop",
+        "dict_argument",
+    ],
+)
+def test_validate_rejects(body, message):
+    tree = ast.parse(PLAN_HEADER + "    " + body + "\n")
+    with pytest.raises(ValueError, match=message):
+        validate_plan(tree, ALLOWED_FUNCTIONS)
+
+
+def test_compile_rejects_invalid_plan():
+    plan = PLAN_HEADER + '    __import__("os").system("ls")\n'
+    compiler = LLMPlanCompiler(FakeAgent(), plan)
+    with pytest.raises(ValueError, match="Unknown function"):
+        compiler.compile()
+    assert plan not in LLMPlanCompiler._tree_cache